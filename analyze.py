@@ -0,0 +1,129 @@
+#!/usr/bin/python
+'''
+USAGE: analyze.py [--bounce <ms>] <file>
+
+Evaluates a recording of input reports made with "hori.py record <file>".
+
+Prints the duration of the recording, the number of input reports and the
+number of reports lost (gaps in the sequence numbers), the profile changes and
+for each button that has been pressed:
+  the number of presses,
+  the number of bounces, i.e. presses less than <ms> (default: 5) after the
+    previous release of the same button, which usually means that a single
+    press of the button was reported as two,
+  the minimum, median, 95th percentile and maximum of the hold times.
+
+The recording is memory-mapped, so recordings of many hours can be evaluated.
+Requires NumPy.
+'''
+import sys
+
+import numpy as np
+
+import hori
+
+RECORD = np.dtype([("time", "<u8"), ("length", "u1"), ("packet", "u1", (31, ))])
+
+
+def load(path):
+    with open(path, "rb") as f:
+        magic = f.read(len(hori.RECORDING_MAGIC))
+    if magic != hori.RECORDING_MAGIC:
+        sys.stderr.write(f"Not a recording: {path}\n")
+        sys.exit(1)
+    return np.memmap(path, dtype=RECORD, mode="r", offset=len(hori.RECORDING_MAGIC))
+
+
+# Returns <values> with the entries where <mask> is False replaced by the last entry before
+# them where <mask> is True (<default> if there is none).
+def fill_forward(values, mask, default=0):
+    idx = np.where(mask, np.arange(len(mask)), -1)
+    np.maximum.accumulate(idx, out=idx)
+    return np.where(idx >= 0, values[np.maximum(idx, 0)], default)
+
+
+# Returns the times (in s since the start of the recording) and the button state (bits of
+# hori.INPUT_BUTTONS) after each input or guide report.
+def button_states(records):
+    packets = records["packet"]
+    kind = packets[:, 0]
+    inputs = (kind == hori.GIP_INPUT) & (records["length"] >= 18)
+    guides = (kind == hori.GIP_GUIDE) & (records["length"] >= 5)
+    keep = inputs | guides
+    packets, inputs, guides = packets[keep], inputs[keep], guides[keep]
+    times = (records["time"][keep] - records["time"][0]) / 1e9
+
+    buttons = packets[:, 4].astype(np.uint32) | (packets[:, 5].astype(np.uint32) << 8)
+    triggers = packets[:, 6:10].view("<u2").reshape(-1, 2)
+    buttons |= np.where(triggers[:, 0] > 0, hori.INPUT_BUTTONS["LT"], 0).astype(np.uint32)
+    buttons |= np.where(triggers[:, 1] > 0, hori.INPUT_BUTTONS["RT"], 0).astype(np.uint32)
+    buttons = fill_forward(buttons, inputs)
+
+    guide = fill_forward((packets[:, 4] & 1).astype(np.uint32), guides)
+    return times, buttons | guide * np.uint32(hori.INPUT_BUTTONS["GUIDE"])
+
+
+# Returns the number of reports missing according to the sequence numbers <seqs>
+def lost_reports(seqs):
+    seqs = seqs.astype(np.int32)
+    gaps = (seqs[1:] - seqs[:-1] - 1) % 256
+    gaps -= (0 < seqs[1:]) & (seqs[1:] < seqs[:-1])  # wrapped around, 0 is skipped
+    gaps[seqs[1:] == seqs[:-1]] = 0
+    return int(gaps.sum())
+
+
+# Returns the times of the presses and the hold times of the button <bit> in <states>
+def presses(times, states, bit):
+    pressed = (states & bit) != 0
+    change = np.diff(pressed.astype(np.int8))
+    down = np.flatnonzero(change == 1) + 1
+    up = np.flatnonzero(change == -1) + 1
+    up = up[np.searchsorted(up, down[0]) if len(down) > 0 else len(up):]
+    down = down[:len(up)]
+    return times[down], times[up] - times[down]
+
+
+if __name__ == "__main__":
+    bounce = 5.0
+    args = sys.argv[1:]
+    try:
+        if len(args) > 1 and args[0] == "--bounce":
+            bounce = float(args[1])
+            args = args[2:]
+        if len(args) != 1:
+            raise ValueError()
+    except ValueError:
+        sys.stderr.write(__doc__)
+        sys.exit(1)
+
+    records = load(args[0])
+    if len(records) == 0:
+        print("Empty recording")
+        sys.exit(0)
+
+    packets = records["packet"]
+    inputs = (packets[:, 0] == hori.GIP_INPUT)
+    duration = (int(records["time"][-1]) - int(records["time"][0])) / 1e9
+    print(f"{duration:.1f} s, {int(inputs.sum())} input reports, "
+          f"{lost_reports(packets[inputs, 2])} lost")
+
+    changes = np.flatnonzero((packets[:, 0] == hori.GIP_REPLY)
+                             & (packets[:, 4] == hori.REPORT_PROFILE))
+    for i in changes:
+        print(f"{(int(records['time'][i]) - int(records['time'][0])) / 1e9:9.3f} s  "
+              f"profile {packets[i, 5]}")
+
+    times, states = button_states(records)
+    if len(times) == 0:
+        sys.exit(0)
+    print(f"{'button':10} {'presses':>7} {'bounces':>7} {'min ms':>8} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'max ms':>8}")
+    for button, bit in hori.INPUT_BUTTONS.items():
+        start, hold = presses(times, states, bit)
+        if len(hold) == 0:
+            continue
+        gaps = start[1:] - (start[:-1] + hold[:-1])
+        bounces = int((gaps < bounce / 1000).sum())
+        ms = hold * 1000
+        print(f"{button:10} {len(hold):7} {bounces:7} {ms.min():8.1f} "
+              f"{np.percentile(ms, 50):8.1f} {np.percentile(ms, 95):8.1f} {ms.max():8.1f}")
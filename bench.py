@@ -0,0 +1,309 @@
+#!/usr/bin/python
+'''
+USAGE: bench.py [--sim] [--warm] [-n <iterations>] [-p <profile>] [-o <file>] [--compare <file>]
+                [--latency <s>] [--jitter <s>] [--drop-rate <p>] [<command> ...]
+
+Benchmarks the hori.py commands hexdump, info, map, reset, name, stick, apply
+and startup (or only the <command>s listed) by running each of them <iterations>
+times.
+
+If a supported controller is connected, the benchmark runs against it (unless
+--sim is given). The commands that modify profile memory operate on <profile>
+(default 4), whose memory is saved before and restored after the benchmark.
+Otherwise the benchmark runs against an in-process SimulatedController from
+hori_sim.py, whose latency model can be adjusted with --latency, --jitter and
+--drop-rate.
+
+For every command, the wall time, the number of requests sent to the controller
+(i.e. USB round trips), the bytes moved over USB and the time spent waiting for
+replies in hori.expect_any() are reported, together with the p50/p99 latency
+of a single run of the command. Every run starts with an empty shadow copy of
+profile memory like a fresh hori.py process, unless --warm is given.
+
+apply feeds the output of "info --json" back to "apply" on a profile with
+buttons overridden with their own function and a name outside the BMP, with the
+buttons that have several names given by their aliases (VIEW, XBOX, MENU). The
+benchmark fails if that writes to the controller, because nothing changes.
+
+The pseudo command startup measures the cold start of "hori.py profile" in a
+new process (the time a shell script calling hori.py waits for it), which should
+stay below STARTUP_TARGET. It runs against the connected controller, or against
+a simulated controller via HORI_SIM if there is none (or --sim is given).
+
+The results are written as JSON to <file> (or stdout), a human readable table
+is written to stderr. --compare reads the JSON of an earlier run and adds the
+relative change of the p50 latencies to the table.
+'''
+import contextlib
+import io
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import hori
+import hori_sim
+
+
+class CountingDevice:
+    '''Wraps a device and counts the traffic that goes through it.'''
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.writes = 0  # CMD_WRITEMEM requests
+        self.bytes_out = 0
+        self.replies = 0
+        self.bytes_in = 0
+
+    def write(self, endpoint, data, timeout=None):
+        self.requests += 1
+        if len(data) > 4 and data[4] == hori.CMD_WRITEMEM:
+            self.writes += 1
+        self.bytes_out += len(data)
+        return self.dev.write(endpoint, data, timeout)
+
+    def read(self, endpoint, size, timeout=None):
+        result = self.dev.read(endpoint, size, timeout)
+        self.replies += 1
+        self.bytes_in += len(result)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.dev, name)
+
+
+expect_time = 0.0
+
+
+def timed_expect_any(expect_any):
+
+    def wrapper(*args, **kwargs):
+        global expect_time
+        start = time.perf_counter()
+        try:
+            return expect_any(*args, **kwargs)
+        finally:
+            expect_time += time.perf_counter() - start
+
+    return wrapper
+
+
+# Applies the output of "info --json" to the controller, which must not write anything
+def apply_info(dev, profile):
+    hori.map_buttons_ex(dev, profile, [(hori.BUTTON2OFS[b], hori.FUNCTION2CODE[b])
+                                       for b in ("A", "VIEW")])
+    hori.rename_profile_ex(dev, profile, "bench \U0001f3ae")
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        hori.info_ex(dev, as_json=True)
+    profiles = json.loads(out.getvalue())
+    for settings in profiles:
+        buttons = settings["buttons"]
+        for alias in ("VIEW", "XBOX", "MENU"):
+            buttons[alias] = buttons.pop(hori.OFS2BUTTON[hori.BUTTON2OFS[alias]])
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+        json.dump(profiles, f)
+        f.flush()
+        desired = hori.read_settings_file(f.name)
+    writes = dev.writes
+    hori.apply_ex(dev, desired)
+    if dev.writes != writes:
+        sys.stderr.write(f"apply wrote {dev.writes - writes} times to an unchanged controller\n")
+        sys.exit(1)
+
+
+COMMANDS = {
+    "hexdump": lambda dev, p: hori.hexdump_ex(dev, p, 0, hori.PROFILE_MEM_SIZE),
+    "info": lambda dev, p: hori.info_ex(dev),
+    "map": lambda dev, p: (hori.map_buttons_ex(dev, p, hori.check_mappings(["A=B", "LB=RB"])),
+                           hori.print_mappings_ex(dev, p)),
+    "reset": lambda dev, p: hori.reset_profile_ex(dev, p),
+    "name": lambda dev, p: (hori.rename_profile_ex(dev, p, "bench"),
+                            hori.print_profile_name_ex(dev, p)),
+    "stick": lambda dev, p: (hori.set_stick_ex(dev, p, "RS"), hori.print_profile_stick_ex(dev, p)),
+    "apply": apply_info,
+}
+
+
+# Wall time in seconds that "hori.py profile" should not exceed when started from the shell
+STARTUP_TARGET = 0.1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def bench(dev, command, profile, iterations, warm):
+    global expect_time
+    run = COMMANDS[command]
+    latencies = []
+    dev.reset()
+    expect_time = 0.0
+    start = time.perf_counter()
+    for _ in range(iterations):
+        if not warm:
+            hori.shadow.clear()
+        t = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            run(dev, profile)
+        latencies.append(time.perf_counter() - t)
+    wall = time.perf_counter() - start
+
+    return {
+        "iterations": iterations,
+        "wall_time": wall,
+        "round_trips": dev.requests / iterations,
+        "bytes_out": dev.bytes_out / iterations,
+        "bytes_in": dev.bytes_in / iterations,
+        "expect_time": expect_time / iterations,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+    }
+
+
+def bench_startup(iterations, simulated, sim_opts):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hori.py")
+    env = dict(os.environ)
+    with tempfile.TemporaryDirectory() as tmp:
+        if simulated:
+            env["HORI_SIM"] = os.path.join(tmp, "sim.bin")
+            env["HORI_SIM_OPTS"] = ",".join(f"{k}={v}" for k, v in sim_opts.items())
+        latencies = []
+        for _ in range(iterations):
+            t = time.perf_counter()
+            subprocess.run([sys.executable, script, "profile"],
+                           env=env,
+                           stdout=subprocess.DEVNULL,
+                           check=True)
+            latencies.append(time.perf_counter() - t)
+
+    return {
+        "iterations": iterations,
+        "target": STARTUP_TARGET,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+    }
+
+
+def open_device(sim, sim_opts):
+    if not sim:
+        try:
+            if len(hori.get_devices()) > 0:
+                return hori.get_controller(), False
+        except Exception as err:
+            sys.stderr.write(f"No USB access ({err}), using simulated controller\n")
+    return hori_sim.SimulatedController(**sim_opts), True
+
+
+def usage():
+    sys.stderr.write(__doc__)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    iterations = 20
+    profile = 4
+    outfile = None
+    compare = None
+    sim = False
+    warm = False
+    sim_opts = {}
+    commands = []
+
+    args = sys.argv[1:]
+    try:
+        while len(args) > 0:
+            arg = args.pop(0)
+            if arg == "--sim":
+                sim = True
+            elif arg == "--warm":
+                warm = True
+            elif arg == "-n":
+                iterations = int(args.pop(0), 0)
+            elif arg == "-p":
+                profile = hori.check_profile(int(args.pop(0), 0))
+            elif arg == "-o":
+                outfile = args.pop(0)
+            elif arg == "--compare":
+                compare = args.pop(0)
+            elif arg == "--latency":
+                sim_opts["latency"] = float(args.pop(0))
+            elif arg == "--jitter":
+                sim_opts["jitter"] = float(args.pop(0))
+            elif arg == "--drop-rate":
+                sim_opts["drop_rate"] = float(args.pop(0))
+            elif arg in COMMANDS or arg == "startup":
+                commands.append(arg)
+            else:
+                usage()
+    except (IndexError, ValueError):
+        usage()
+
+    if len(commands) == 0:
+        commands = list(COMMANDS) + ["startup"]
+    if iterations < 1:
+        usage()
+    startup = "startup" in commands
+    commands = [c for c in commands if c != "startup"]
+
+    raw, simulated = open_device(sim, sim_opts)
+    dev = CountingDevice(raw)
+    hori.expect_any = timed_expect_any(hori.expect_any)
+
+    saved = hori.read_ex(dev, profile, 0, hori.PROFILE_MEM_SIZE)
+    results = {
+        "device": "simulated" if simulated else f"{raw.manufacturer} {raw.product}",
+        "pipeline_depth": hori.PIPELINE_DEPTH,
+        "warm": warm,
+        "commands": {},
+    }
+    try:
+        for command in commands:
+            results["commands"][command] = bench(dev, command, profile, iterations, warm)
+    finally:
+        hori.write_ex(dev, profile, 0, saved)
+        if not simulated:
+            hori.release_controller(raw)
+
+    # Only after the controller has been released, so that hori.py can claim it
+    if startup:
+        results["startup"] = bench_startup(iterations, simulated, sim_opts)
+
+    previous = {}
+    if compare is not None:
+        with open(compare) as f:
+            previous = json.load(f)
+
+    sys.stderr.write(f"{'command':8} {'p50 ms':>8} {'p99 ms':>8} {'trips':>6} {'bytes':>7} "
+                     f"{'wait ms':>8}\n")
+    for command, r in results["commands"].items():
+        line = (f"{command:8} {r['p50'] * 1000:8.2f} {r['p99'] * 1000:8.2f} "
+                f"{r['round_trips']:6.1f} {r['bytes_out'] + r['bytes_in']:7.0f} "
+                f"{r['expect_time'] * 1000:8.2f}")
+        if command in previous.get("commands", {}):
+            line += f" {(r['p50'] / previous['commands'][command]['p50'] - 1) * 100:+6.1f}%"
+        sys.stderr.write(line + "\n")
+    if startup:
+        r = results["startup"]
+        verdict = "ok" if r["p50"] <= r["target"] else "MISSED"
+        line = (f"{'startup':8} {r['p50'] * 1000:8.2f} {r['p99'] * 1000:8.2f}  "
+                f"target {r['target'] * 1000:.0f} ms: {verdict}")
+        if "startup" in previous:
+            line += f" {(r['p50'] / previous['startup']['p50'] - 1) * 100:+6.1f}%"
+        sys.stderr.write(line + "\n")
+
+    if outfile is None:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(outfile, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
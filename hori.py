@@ -24,17 +24,75 @@ SOFTWARE.
 */
 
 '''
+from __future__ import annotations
+
+import collections
+import errno
+import os
 import sys
-import usb.core
-import usb.util
+import threading
 import time
-import typing
+
+# usb, typing and the modules only needed by some commands are imported where they are used,
+# so that parsing the command line and talking to the device is not delayed by imports
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    import typing
+    import usb.core
 
 PROFILE_MEM_SIZE = 421
 
+# Maximum number of bytes transferred by a single CMD_READMEM/CMD_WRITEMEM
+CHUNK_SIZE = 55
+
+# Maximum number of memory requests sent to the controller before waiting for replies
+PIPELINE_DEPTH = 4
+
+# Maximum number of unsolicited reports kept until they are processed
+REPORT_QUEUE_SIZE = 4096
+
 seqnum = 0
+# Several controllers may be used from different threads at the same time, e.g. by the
+# worker threads of hori_async.HoriController
+seqnum_lock = threading.Lock()
 devnum = 0
 
+# Time in seconds to wait for the reply to a request before the request is sent again
+reply_timeout = 0.1
+
+# Number of times a request is sent again before giving up
+retries = 2
+
+# Maps each device to the Reader that receives its packets
+readers = {}
+readers_lock = threading.Lock()
+
+# Shadow copies of profile memory. Maps each device to a dict that maps profile numbers to
+# bytearrays of PROFILE_MEM_SIZE bytes.
+shadow = {}
+
+# Maps each device to the set of profiles whose shadow copies were loaded from the
+# cache file and have not been checked against the controller in this session.
+shadow_unverified = {}
+
+# If not None, shadow copies are loaded from and saved to this directory
+cache_dir = None
+
+# If True, shadow copies loaded from the cache directory are checked against the controller
+verify_cache = False
+
+# If True, shadow copies are not loaded from the cache directory (but still saved)
+refresh_cache = False
+
+# Functions called with (device, profile) for every 0x0d profile change report
+profile_listeners = []
+
+# If not None, commands are sent to the daemon listening on this Unix socket
+socket_path = None
+
+# If not None, the Tracer that records all packets sent to and received from the controllers
+tracer = None
+
 GIP_REQUEST = 0xf
 GIP_REPLY = 0x10
 
@@ -48,6 +106,11 @@ REPLY_MEM = 5
 REPLY_DONE = 6
 REPLY_VERSION = 0xa
 REPLY_PROFILE = 0xc
+REPORT_PROFILE = 0xd
+
+# Unsolicited GIP packets the controller sends on its own
+GIP_GUIDE = 0x07
+GIP_INPUT = 0x20
 
 # Default values to write to a profile starting at offset 0x20 (i.e. after the profile name)
 PROFILE_DEFAULT = [
@@ -130,6 +193,46 @@ FUNCTION2CODE = {
     "DISABLED": 0x21
 }
 
+# Reverse index of FUNCTION2CODE. For codes with several names the last one is used.
+CODE2FUNCTION = {code: function for function, code in FUNCTION2CODE.items()}
+
+# (button, offset) for each button in BUTTON2OFS, using the first of several names
+BUTTONS = [(b, ofs) for b, ofs in BUTTON2OFS.items() if b == next(
+    name for name, o in BUTTON2OFS.items() if o == ofs)]
+
+# Maps the offset of each button to its name in BUTTONS
+OFS2BUTTON = {ofs: b for b, ofs in BUTTONS}
+
+# Bits of the button word of a GIP_INPUT report (little endian u16 at offset 4). GUIDE is
+# reported with GIP_GUIDE, LT and RT are analog. They get bits above the button word.
+INPUT_BUTTONS = {
+    "START": 1 << 2,
+    "SELECT": 1 << 3,
+    "A": 1 << 4,
+    "B": 1 << 5,
+    "X": 1 << 6,
+    "Y": 1 << 7,
+    "DPAD-UP": 1 << 8,
+    "DPAD-DOWN": 1 << 9,
+    "DPAD-LEFT": 1 << 10,
+    "DPAD-RIGHT": 1 << 11,
+    "LB": 1 << 12,
+    "RB": 1 << 13,
+    "LSB": 1 << 14,
+    "RSB": 1 << 15,
+    "GUIDE": 1 << 16,
+    "LT": 1 << 17,
+    "RT": 1 << 18,
+}
+
+# Analog stick function at offset 0x18a
+STICK_LS = bytes([0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0])
+STICK_RS = bytes([1, 0, 0, 1, 0, 0, 2, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 1])
+
+
+class HoriError(Exception):
+    pass
+
 
 def hexstr(data: typing.Iterable[int]):
     st = ""
@@ -140,45 +243,566 @@ def hexstr(data: typing.Iterable[int]):
 
 def horicmd(cmd: typing.Iterable[int]):
     global seqnum
-    seqnum += 1
-    b = [GIP_REQUEST, 0, seqnum, len(cmd)]
+    # The sequence number is a single byte. 0 is skipped because the OS uses it.
+    with seqnum_lock:
+        seqnum = seqnum % 255 + 1
+        seq = seqnum
+    b = [GIP_REQUEST, 0, seq, len(cmd)]
     b.extend(cmd)
     return bytes(b)
 
 
-def send(dev: usb.core.Device, cmd: typing.Iterable[int]):
-    dev.write(2, horicmd(cmd))
+def send(dev: usb.core.Device, cmd: typing.Iterable[int]) -> int:
+    packet = horicmd(cmd)
+    # Register the sequence number before sending, so the reply can't be missed
+    get_reader(dev).expect(packet[2])
+    if tracer is not None:
+        tracer.packet(dev, "out", packet)
+    dev.write(2, packet)
+    return packet[2]
+
+
+# Waits for a reply of type <reply> to any of the requests whose sequence numbers are the
+# keys of <pending>. The values of <pending> are the payload sizes of the respective replies
+# (None for replies of variable size, whose complete payload is returned).
+# Returns the tuple (sequence number, payload) or None if no reply arrived within <timeout>
+# seconds (default: reply_timeout).
+def expect_any(dev: usb.core.Device,
+               reply: int,
+               pending: typing.Dict[int, int],
+               timeout: float = None):
+    reader = get_reader(dev)
+    deadline = time.monotonic() + (reply_timeout if timeout is None else timeout)
+    while True:
+        result = reader.wait(pending, deadline)
+        if result is None:
+            return None
+        seq, packet = result
+        sz = pending[seq]
+        if sz is None:
+            sz = packet[3] - 1
+        if packet[1] == 0 and packet[3] - 1 >= sz and packet[4] == reply:
+            return seq, packet[5:5 + sz]
+        reader.note_stray(packet)
+
+
+def missing_reply_message(dev: usb.core.Device, reply: int, seqs: typing.Iterable[int]) -> str:
+    seqs = ", ".join(hex(seq) for seq in seqs)
+    msg = f"Did not receive expected reply {hex(reply)} with sequence number {seqs}"
+    stray = get_reader(dev).stray
+    if len(stray) > 0:
+        msg += "\nReceived:\n" + "\n".join(hexstr(r) for r in stray)
+    return msg
+
+
+# Splits the memory range of <sz> bytes starting at <ofs> into (start, count) pieces that
+# fit into a single memory command.
+def chunks(ofs: int, sz: int):
+    return [(start, min(CHUNK_SIZE, ofs + sz - start))
+            for start in range(ofs, ofs + sz, CHUNK_SIZE)]
+
+
+# Sends all <cmds> to the controller, keeping up to <depth> (default: PIPELINE_DEPTH) of them
+# in flight, and yields (index into cmds, payload) for each reply of type <reply> in the
+# order of arrival. <sizes> are the payload sizes of the replies. A request that is not
+# answered within reply_timeout is sent again (with a new sequence number) up to <retries>
+# times. <cmds> and <sizes> may be iterators, which are only advanced when there is room
+# for another request, so commands can be supplied while the replies arrive.
+# If a request is still not answered after that, HoriError is raised, or with <missing_ok>,
+# (index into cmds, None) is yielded.
+def pipeline(dev: usb.core.Device,
+             cmds: typing.Iterable[typing.Sequence[int]],
+             reply: int,
+             sizes: typing.Iterable[int],
+             depth: int = None,
+             missing_ok: bool = False):
+    if depth is None:
+        depth = PIPELINE_DEPTH
+    reader = get_reader(dev)
+    reader.stray.clear()
+    source = zip(cmds, sizes)
+    cmds = []  # commands taken from source
+    sizes = []
+    pending = {}  # maps sequence number to index into cmds
+    sent = {}  # maps index into cmds to the time the command was last sent
+    attempts = []
+    exhausted = False
+    while not exhausted or len(pending) > 0:
+        while not exhausted and len(pending) < depth:
+            item = next(source, None)
+            if item is None:
+                exhausted = True
+                break
+            nxt = len(cmds)
+            cmds.append(item[0])
+            sizes.append(item[1])
+            attempts.append(0)
+            pending[send(dev, cmds[nxt])] = nxt
+            sent[nxt] = time.monotonic()
+        if len(pending) == 0:
+            break
 
+        oldest = min(pending, key=lambda seq: sent[pending[seq]])
+        timeout = sent[pending[oldest]] + reply_timeout - time.monotonic()
+        result = expect_any(dev, reply, {seq: sizes[i] for seq, i in pending.items()}, timeout)
+        if result is None:
+            i = pending.pop(oldest)
+            reader.forget(oldest)
+            if tracer is not None:
+                tracer.retry(dev, oldest, cmds[i][0], attempts[i] < retries)
+            if attempts[i] >= retries and missing_ok:
+                yield i, None
+                continue
+            if attempts[i] >= retries:
+                for seq in pending:
+                    reader.forget(seq)
+                raise HoriError(missing_reply_message(dev, reply, [oldest]))
+            attempts[i] += 1
+            pending[send(dev, cmds[i])] = i
+            sent[i] = time.monotonic()
+            continue
 
-def expect(dev: usb.core.Device, reply: int, sz: int = 0) -> bytes:
-    timeout = time.time() + .1
-    received = []
-    while time.time() < timeout:
-        try:
-            result = dev.read(0x82, 128, 100)
-            if result[0] == GIP_REPLY and result[1] == 0 and result[
-                    2] == seqnum and result[3] - 1 >= sz and result[4] == reply:
-                return result[5:5 + sz]
-            received.append(result[0:9])
-        except:
-            pass
+        seq, data = result
+        yield pending.pop(seq), data
+
+
+# Sends <cmd> and returns the payload of the reply of type <reply>.
+def transact(dev: usb.core.Device, cmd: typing.Sequence[int], reply: int, sz: int = 0) -> bytes:
+    return next(pipeline(dev, [cmd], reply, [sz]))[1]
+
+
+def is_timeout(err: Exception) -> bool:
+    return (isinstance(err, TimeoutError) or type(err).__name__ == "USBTimeoutError"
+            or getattr(err, "errno", None) == errno.ETIMEDOUT
+            or getattr(err, "backend_error_code", None) == -7)
+
+
+class Reader:
+    '''
+    Reads the packets from endpoint 0x82 of a device in a background thread. Replies are
+    handed to the waiter for their sequence number. Reports the controller sends on its own
+    (0x0d profile changes, input reports) are kept in the queue <reports> while it is held
+    by hold() with <reports>.
+
+    The thread only reads while replies are expected or while it is held by hold(), so
+    that the device can be released without waiting for a read to time out.
+    '''
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.cond = threading.Condition()
+        self.expected = set()  # sequence numbers of requests waiting for a reply
+        self.replies = {}  # replies that arrived for expected sequence numbers
+        self.stray = collections.deque(maxlen=16)  # start of packets nobody waited for
+        self.reports = collections.deque(maxlen=REPORT_QUEUE_SIZE)
+        self.overflows = 0  # number of reports dropped because <reports> was full
+        self.holds = 0
+        self.report_holds = 0  # holds that want the reports in <reports>
+        self.running = True
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and len(self.expected) == 0 and self.holds == 0:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                timeout = 20 if len(self.expected) > 0 else 500
+
+            try:
+                packet = bytes(self.dev.read(0x82, 128, timeout))
+            except Exception as err:
+                if is_timeout(err):
+                    continue
+                with self.cond:
+                    self.error = err
+                    self.cond.notify_all()
+                return
+
+            if tracer is not None:
+                tracer.packet(self.dev, "in", packet)
+            if len(packet) < 5:
+                continue
+            if packet[0] == GIP_REPLY and packet[4] == REPORT_PROFILE:
+                profile_changed(self.dev, packet[5])
+            with self.cond:
+                if packet[0] == GIP_REPLY and packet[4] != REPORT_PROFILE:
+                    if packet[2] in self.expected:
+                        self.expected.discard(packet[2])
+                        self.replies[packet[2]] = packet
+                    else:
+                        self.stray.append(packet[0:9])
+                    self.cond.notify_all()
+                elif self.report_holds > 0:
+                    if len(self.reports) == REPORT_QUEUE_SIZE:
+                        self.overflows += 1
+                    self.reports.append((time.monotonic(), packet))
+                    self.cond.notify_all()
+
+    def expect(self, seq: int):
+        with self.cond:
+            self.replies.pop(seq, None)
+            self.expected.add(seq)
+            self.cond.notify_all()
+
+    def forget(self, seq: int):
+        with self.cond:
+            self.expected.discard(seq)
+            self.replies.pop(seq, None)
+
+    def note_stray(self, packet: bytes):
+        self.stray.append(packet[0:9])
+
+    # Waits until the reply for one of the sequence numbers <seqs> has arrived or until
+    # time.monotonic() reaches <deadline>. Returns (sequence number, packet) or None.
+    def wait(self, seqs: typing.Iterable[int], deadline: float):
+        with self.cond:
+            while True:
+                for seq in seqs:
+                    if seq in self.replies:
+                        return seq, self.replies.pop(seq)
+                if self.error is not None:
+                    raise HoriError(f"Error reading from device: {self.error}")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+    # Waits for the next report until time.monotonic() reaches <deadline> (forever if None).
+    # Returns (time of arrival, packet) or None.
+    def next_report(self, deadline: float = None):
+        with self.cond:
+            while len(self.reports) == 0:
+                if self.error is not None:
+                    raise HoriError(f"Error reading from device: {self.error}")
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self.cond.wait(remaining)
+            return self.reports.popleft()
+
+    # Keeps the thread reading while no replies are expected, so that reports are received.
+    # Without <reports>, they are only passed to profile_listeners and not queued, so that
+    # waiting threads are not woken up for every input report.
+    def hold(self, reports: bool = True):
+        with self.cond:
+            self.holds += 1
+            if reports:
+                self.report_holds += 1
+            self.cond.notify_all()
+
+    def unhold(self, reports: bool = True):
+        with self.cond:
+            self.holds -= 1
+            if reports:
+                self.report_holds -= 1
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+
+
+# Names of the commands in traces
+CMD_NAMES = {
+    CMD_WRITEMEM: "WRITEMEM",
+    CMD_READMEM: "READMEM",
+    CMD_SWITCH_PROFILE: "SWITCH_PROFILE",
+    CMD_GET_VERSION: "GET_VERSION",
+    CMD_GET_PROFILE: "GET_PROFILE",
+}
+
+
+class Tracer:
+    '''
+    Records the packets sent to and received from the controllers and the requests that are
+    sent again, and derives the round trip time of each request from them.
+
+    If <path> is not None, every packet is written to <path>: as pcap file with usbmon
+    headers (LINKTYPE_USB_LINUX) that can be opened with Wireshark if <path> ends in .pcap,
+    otherwise as one JSON object per line with the fields t (time.monotonic()), dir ("out"
+    or "in"), seq, cmd and data (the whole packet in hex), or with the field event ("retry"
+    or "timeout") for requests that were not answered in time.
+    '''
+
+    def __init__(self, path: str = None):
+        import struct
+        self.lock = threading.Lock()
+        self.pcap = path is not None and path.endswith(".pcap")
+        self.file = None
+        if path is not None:
+            try:
+                self.file = open(path, "wb")
+            except OSError as err:
+                raise HoriError(str(err))
+        if self.pcap:
+            self.file.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 189))
+            self.usbmon = struct.Struct("<QBBBBHbbqiiII8s")
+            self.record = struct.Struct("<IIII")
+        self.offset = time.time() - time.monotonic()
+        self.urbs = 0
+        self.outstanding = {}  # (device, seq) -> (time sent, cmd)
+        self.sent = collections.Counter()  # cmd -> number of requests
+        self.rtts = collections.defaultdict(list)  # cmd -> round trip times of the replies
+        self.retries = collections.Counter()
+        self.timeouts = collections.Counter()
+        self.stray = 0  # replies for requests that were not (or no longer) outstanding
+        self.reports = 0  # packets the controller sent on its own
+
+    def packet(self, dev, direction: str, packet: bytes):
+        t = time.monotonic()
+        with self.lock:
+            if direction == "out" and len(packet) > 4:
+                self.sent[packet[4]] += 1
+                self.outstanding[(id(dev), packet[2])] = (t, packet[4])
+            elif direction == "in":
+                if len(packet) < 5 or packet[0] != GIP_REPLY or packet[4] == REPORT_PROFILE:
+                    self.reports += 1
+                else:
+                    request = self.outstanding.pop((id(dev), packet[2]), None)
+                    if request is None:
+                        self.stray += 1
+                    else:
+                        self.rtts[request[1]].append(t - request[0])
+
+            if self.file is None:
+                return
+            if self.pcap:
+                self.write_pcap(dev, t, direction, packet)
+            else:
+                self.write_json({
+                    "t": t,
+                    "dir": direction,
+                    "seq": packet[2] if len(packet) > 2 else None,
+                    "cmd": packet[4] if len(packet) > 4 else None,
+                    "data": bytes(packet).hex()
+                })
+
+    # Called by pipeline() for a request that has not been answered in time, with <again> True
+    # if it is sent again.
+    def retry(self, dev, seq: int, cmd: int, again: bool):
+        t = time.monotonic()
+        with self.lock:
+            self.outstanding.pop((id(dev), seq), None)
+            if again:
+                self.retries[cmd] += 1
+            else:
+                self.timeouts[cmd] += 1
+            if self.file is not None and not self.pcap:
+                self.write_json({"t": t, "event": "retry" if again else "timeout", "seq": seq,
+                                 "cmd": cmd})
+
+    def write_json(self, obj):
+        import json
+        self.file.write((json.dumps(obj) + "\n").encode())
+
+    def write_pcap(self, dev, t: float, direction: str, packet: bytes):
+        t += self.offset
+        sec = int(t)
+        usec = int((t - sec) * 1e6)
+        self.urbs += 1
+        # Requests are traced as URB submissions, packets from the controller as completions
+        header = self.usbmon.pack(self.urbs, ord("S") if direction == "out" else ord("C"), 1,
+                                  0x02 if direction == "out" else 0x82,
+                                  getattr(dev, "address", 0) & 255,
+                                  getattr(dev, "bus", 0) & 0xffff, ord("-"), 0, sec, usec, 0,
+                                  len(packet), len(packet), bytes(8))
+        self.file.write(self.record.pack(sec, usec, len(header) + len(packet),
+                                         len(header) + len(packet)))
+        self.file.write(header)
+        self.file.write(packet)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def print_stats(self):
+        out = sys.stderr
+        out.write(f"{'command':15} {'sent':>6} {'replies':>7} {'retries':>7} {'timeouts':>8} "
+                  f"{'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}\n")
+        for cmd in sorted(self.sent):
+            rtts = sorted(self.rtts[cmd])
+            line = (f"{CMD_NAMES.get(cmd, hex(cmd)):15} {self.sent[cmd]:6} {len(rtts):7} "
+                    f"{self.retries[cmd]:7} {self.timeouts[cmd]:8}")
+            if len(rtts) > 0:
+                line += (f" {rtts[len(rtts) // 2] * 1000:8.2f}"
+                         f" {rtts[int(len(rtts) * 0.99)] * 1000:8.2f} {rtts[-1] * 1000:8.2f}")
+            out.write(line + "\n")
+        out.write(f"{self.stray} stray replies, {self.reports} reports\n")
+
+
+def get_reader(dev: usb.core.Device) -> Reader:
+    with readers_lock:
+        reader = readers.get(dev)
+        if reader is None:
+            reader = readers[dev] = Reader(dev)
+    return reader
+
+
+def stop_reader(dev: usb.core.Device):
+    with readers_lock:
+        reader = readers.pop(dev, None)
+    if reader is not None:
+        reader.stop()
+
+
+def read_ex(dev: usb.core.Device, profile: int, ofs: int, sz: int) -> bytearray:
+    return read_ranges_ex(dev, [(profile, ofs, sz)])[0]
+
+
+# Reads all <ranges>, which are (profile, ofs, sz) tuples, in one pipelined sweep and
+# returns a list with one bytearray per range.
+def read_ranges_ex(dev: usb.core.Device, ranges: typing.List[typing.Tuple[int, int, int]]):
+    cmds = []
+    owner = []
+    for r, (profile, ofs, sz) in enumerate(ranges):
+        for start, n in chunks(ofs, sz):
+            cmds.append((CMD_READMEM, profile, start >> 8, start & 255, n))
+            owner.append(r)
+
+    results = [bytearray(sz) for _, _, sz in ranges]
+    for idx, data in pipeline(dev, cmds, REPLY_MEM, [cmd[4] + 4 for cmd in cmds]):
+        # Replies may arrive out of order. Use the offset from the reply to place the data.
+        r = owner[idx]
+        start = (data[1] << 8) + data[2] - ranges[r][1]
+        results[r][start:start + data[3]] = data[4:4 + data[3]]
+
+    for (profile, ofs, _), result in zip(ranges, results):
+        update_shadow(dev, profile, ofs, result)
+    return results
+
+
+# Returns the shadow copy of the memory of <profile>, reading it from the controller if
+# necessary. The result must not be modified.
+def profile_image(dev: usb.core.Device, profile: int) -> bytearray:
+    return profile_images(dev, (profile, ))[0]
+
+
+# Like profile_image() for multiple profiles. Missing shadow copies are read in one sweep.
+def profile_images(dev: usb.core.Device, profiles: typing.Iterable[int]):
+    images = shadow.setdefault(dev, {})
+    missing = [p for p in profiles if p not in images]
+    if len(missing) > 0:
+        for p, image in zip(missing,
+                            read_ranges_ex(dev, [(p, 0, PROFILE_MEM_SIZE) for p in missing])):
+            images[p] = image
+    return [images[p] for p in profiles]
+
+
+# Updates the shadow copy of <profile> (if there is one) with <data> that has been read
+# from or written to the controller at <ofs>.
+def update_shadow(dev: usb.core.Device, profile: int, ofs: int, data: typing.Sequence[int]):
+    image = shadow.get(dev, {}).get(profile)
+    if image is None or ofs >= len(image):
+        return
+    end = min(len(image), ofs + len(data))
+    image[ofs:end] = bytes(data[:end - ofs])
+
+
+# Called for every 0x0d report. A profile change shows that the controller has been used
+# since the cache file was written, so shadow copies from the cache file can't be trusted.
+def profile_changed(dev: usb.core.Device, profile: int):
+    images = shadow.get(dev, {})
+    for p in shadow_unverified.pop(dev, set()):
+        images.pop(p, None)
+    for listener in profile_listeners:
+        listener(dev, profile)
+
+
+def cache_file(dev: usb.core.Device) -> str:
+    try:
+        ident = dev.serial_number
+    except:
+        ident = None
+    if not ident:
+        ident = f"{dev.bus}-{dev.address}"
+    return os.path.join(cache_dir, f"{dev.idVendor:04x}-{dev.idProduct:04x}-{ident}.bin")
+
+
+# The cache file contains for each profile a byte that is 1 if the profile's shadow copy
+# is present, followed by PROFILE_MEM_SIZE bytes of profile memory.
+def load_shadow(dev: usb.core.Device):
+    try:
+        with open(cache_file(dev), "rb") as f:
+            data = f.read()
+    except OSError:
+        return
+    if len(data) != 4 * (PROFILE_MEM_SIZE + 1):
+        return
+
+    images = shadow.setdefault(dev, {})
+    unverified = shadow_unverified.setdefault(dev, set())
+    for p in (1, 2, 3, 4):
+        start = (p - 1) * (PROFILE_MEM_SIZE + 1)
+        if data[start] == 1:
+            images[p] = bytearray(data[start + 1:start + 1 + PROFILE_MEM_SIZE])
+            unverified.add(p)
+
+    if verify_cache:
+        verify_shadow(dev)
+
+
+# Reads the profiles whose shadow copies came from the cache file and replaces the shadow
+# copies that differ from the controller's memory.
+def verify_shadow(dev: usb.core.Device):
+    images = shadow.get(dev, {})
+    profiles = sorted(shadow_unverified.pop(dev, set()))
+    cached = [bytes(images[p]) for p in profiles]
+    # read_ranges_ex() updates the shadow copies
+    for p, old, live in zip(profiles, cached,
+                            read_ranges_ex(dev, [(p, 0, PROFILE_MEM_SIZE) for p in profiles])):
+        if old != live:
+            sys.stderr.write(f"Cached memory of profile {p} was out of date\n")
+
+
+def save_shadow(dev: usb.core.Device):
+    images = shadow.get(dev, {})
+    data = bytearray()
+    for p in (1, 2, 3, 4):
+        if p in images:
+            data.append(1)
+            data.extend(images[p])
+        else:
+            data.extend(bytes(PROFILE_MEM_SIZE + 1))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_file(dev)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+# If HORI_SIM is set, simulated controllers from hori_sim.py are used instead of USB devices
+def find_devices(**kwargs):
+    if os.environ.get("HORI_SIM"):
+        import hori_sim
+        return hori_sim.find(**kwargs)
+    import usb.core
+    return usb.core.find(**kwargs)
 
-    sys.stderr.write(
-        f"Did not receive expected reply {hex(reply)} with sequence number {hex(seqnum)}\n")
-    if len(received) > 0:
-        sys.stderr.write("Received:\n")
-        for r in received:
-            sys.stderr.write(hexstr(r) + "\n")
-    sys.exit(1)
+
+# Supported devices in the order of their device numbers. The bus is only enumerated once,
+# the device objects are reused by get_controller() and devices().
+found_devices = None
+found_devices_lock = threading.Lock()
 
 
 def get_devices():
-    device_list = []
-    devs = usb.core.find(find_all=True, idVendor=0x0f0d)
-    for d in devs:
-        if d.idProduct == 0x0150:
-            device_list.append((d.idVendor, d.idProduct, d.bus, d.address))
-    return device_list
+    global found_devices
+    with found_devices_lock:
+        if found_devices is None:
+            devs = find_devices(find_all=True, idVendor=0x0f0d)
+            found_devices = [d for d in devs if d.idProduct == 0x0150]
+    return [(d.idVendor, d.idProduct, d.bus, d.address) for d in found_devices]
 
 
 def check_device():
@@ -188,49 +812,53 @@ def check_device():
         sys.exit(1)
 
 
-def get_controller() -> usb.core.Device:
+def get_controller(num: int = None) -> usb.core.Device:
+    if num is None:
+        num = devnum
     device_list = get_devices()
-    dev = usb.core.find(idVendor=device_list[devnum][0],
-                        idProduct=device_list[devnum][1],
-                        bus=device_list[devnum][2],
-                        address=device_list[devnum][3])
-    if dev is None:
+    if num < 0 or num >= len(device_list):
         sys.stderr.write("Could not find device\n")
         sys.exit(1)
+    dev = found_devices[num]
 
     try:
         dev.detach_kernel_driver(0)
     except:
         pass
 
+    if cache_dir is not None and not refresh_cache:
+        load_shadow(dev)
+
     return dev
 
 
 def release_controller(dev):
-    usb.util.dispose_resources(dev)
+    stop_reader(dev)
+    if cache_dir is not None:
+        save_shadow(dev)
+    # Simulated controllers are not usb.core.Devices and don't need usb to be imported
+    usb_core = sys.modules.get("usb.core")
+    if usb_core is not None and isinstance(dev, usb_core.Device):
+        import usb.util
+        usb.util.dispose_resources(dev)
     try:
         dev.attach_kernel_driver(0)
     except:
         pass
 
 
-def hexdump(profile, ofs, sz):
+def hexdump_ex(dev, profile, ofs, sz, binary=False):
     #print(f"Dumping {sz} bytes of mem from profile {profile} at offset {hex(ofs)}")
-    dev = get_controller()
+    result = read_ex(dev, profile, ofs, sz)
 
-    bigblocks = sz // 55
-    rest = sz % 55
-    result = []
-
-    for b in range(0, bigblocks):
-        start = b * 55 + ofs
-        send(dev, (CMD_READMEM, profile, start >> 8, start & 255, 55))
-        result.extend(expect(dev, REPLY_MEM, 59)[4:])
-
-    if rest > 0:
-        start = bigblocks * 55 + ofs
-        send(dev, (CMD_READMEM, profile, start >> 8, start & 255, rest))
-        result.extend(expect(dev, REPLY_MEM, rest + 4)[4:])
+    if binary:
+        out = getattr(sys.stdout, "buffer", None)
+        if out is None:
+            raise HoriError("Binary output is not possible here")
+        sys.stdout.flush()
+        out.write(result)
+        out.flush()
+        return
 
     start = 0
     while start + 8 <= len(result):
@@ -239,105 +867,252 @@ def hexdump(profile, ofs, sz):
     if start < len(result):
         print(hexstr(result[start:]))
 
-    release_controller(dev)
 
+def write_ex(dev, profile, ofs, data):
+    write_pieces_ex(dev, profile, [(ofs, data)])
 
-def write(profile, ofs, data):
-    dev = get_controller()
-    write_ex(dev, profile.ofs, data)
-    release_controller(dev)
 
+# Writes all <pieces>, which are (ofs, data) tuples, in one pipelined sweep.
+def write_pieces_ex(dev, profile, pieces):
+    cmds = []
+    for ofs, data in pieces:
+        for start, n in chunks(ofs, len(data)):
+            cmd = [CMD_WRITEMEM, profile, start >> 8, start & 255, n]
+            cmd.extend(data[start - ofs:start - ofs + n])
+            cmds.append(cmd)
 
-def write_ex(dev, profile, ofs, data):
-    sz = len(data)
-    bigblocks = sz // 55
-    rest = sz % 55
-
-    for b in range(0, bigblocks):
-        start = b * 55 + ofs
-        cmd = [CMD_WRITEMEM, profile, start >> 8, start & 255, 55]
-        cmd.extend(data[start - ofs:start - ofs + 55])
-        send(dev, cmd)
-        expect(dev, REPLY_DONE)
-
-    if rest > 0:
-        start = bigblocks * 55 + ofs
-        cmd = [CMD_WRITEMEM, profile, start >> 8, start & 255, rest]
-        cmd.extend(data[start - ofs:start - ofs + rest])
-        send(dev, cmd)
-        expect(dev, REPLY_DONE)
-
-
-def activate_profile(profile):
+    for _ in pipeline(dev, cmds, REPLY_DONE, [0] * len(cmds)):
+        pass
+
+    for ofs, data in pieces:
+        update_shadow(dev, profile, ofs, data)
+
+
+# Returns the (ofs, data) pieces that need to be written to change memory that contains
+# <current> at <ofs> to <desired>. Unchanged bytes between changed bytes are rewritten
+# whenever that saves a CMD_WRITEMEM, so the result needs as few commands as possible.
+def plan_writes(current: typing.Sequence[int], desired: typing.Sequence[int], ofs: int = 0):
+    dirty = [i for i in range(len(desired)) if current[i] != desired[i]]
+    pieces = []
+    i = 0
+    while i < len(dirty):
+        start = dirty[i]
+        # Extend the piece to the last changed byte that fits into the same command
+        while i + 1 < len(dirty) and dirty[i + 1] < start + CHUNK_SIZE:
+            i += 1
+        end = dirty[i] + 1
+        pieces.append((ofs + start, bytes(desired[start:end])))
+        i += 1
+    return pieces
+
+
+# Changes the memory of <profile> starting at <ofs> to <data>, writing only the bytes that
+# differ from the shadow copy (or from one read of just these bytes if there is none).
+def update_ex(dev, profile, ofs, data):
+    current = read_span_ex(dev, profile, ofs, ofs + len(data) - 1)
+    pieces = plan_writes(current, data, ofs)
+    if len(pieces) > 0:
+        write_pieces_ex(dev, profile, pieces)
+
+
+# Returns the bytes <first> to <last> of the memory of <profile>, from the shadow copy if there
+# is one, otherwise with one pipelined read of just these bytes.
+def read_span_ex(dev, profile, first, last) -> bytearray:
+    image = shadow.get(dev, {}).get(profile)
+    if image is not None:
+        return bytearray(image[first:last + 1])
+    return read_ex(dev, profile, first, last - first + 1)
+
+
+# Changes the scattered bytes <fields> (a dict that maps offsets to values) of <profile> with
+# as few CMD_WRITEMEMs as possible. The bytes between the fields are taken from the shadow
+# copy or from one read of the range the fields span, so fields closer together than
+# CHUNK_SIZE can be written with one command, and fields that already have their value are
+# not written at all. Returns (first offset of the range, range after the change).
+def write_fields_ex(dev, profile, fields: typing.Dict[int, int]):
+    first = min(fields)
+    current = read_span_ex(dev, profile, first, max(fields))
+    desired = bytearray(current)
+    for ofs, value in fields.items():
+        desired[ofs - first] = value
+    pieces = plan_writes(current, desired, first)
+    if len(pieces) > 0:
+        write_pieces_ex(dev, profile, pieces)
+    return first, desired
+
+
+def activate_profile_ex(dev, profile):
     print(f"Activating profile {profile}")
-    dev = get_controller()
-    send(dev, (CMD_SWITCH_PROFILE, profile))
-    expect(dev, REPLY_DONE)
-    release_controller(dev)
+    transact(dev, (CMD_SWITCH_PROFILE, profile), REPLY_DONE)
 
 
-def reset_profile(profile):
+def reset_profile_ex(dev, profile):
     print(f"Resetting profile {profile} to default values")
-    write(profile, 0x20, PROFILE_DEFAULT)
+    update_ex(dev, profile, 0x20, PROFILE_DEFAULT)
 
 
-def print_active_profile_number():
-    dev = get_controller()
-    send(dev, (CMD_GET_PROFILE, ))
-    result = expect(dev, REPLY_PROFILE, 2)
+def print_active_profile_number_ex(dev):
+    result = transact(dev, (CMD_GET_PROFILE, ), REPLY_PROFILE, 2)
     print(f"Current profile is {result[0]}")
-    release_controller(dev)
 
 
-def rename_profile(profile: int, name: str):
-    if len(name) > 16:
+# The name is stored as UTF-16, so a character outside the BMP counts as two of the 16
+def check_name(name: str):
+    if len(name.encode("utf-16-le")) > 32:
         sys.stderr.write(f"Name too long (must be at most 16 characters): {name}\n")
         sys.exit(1)
+    return name
 
-    dev = get_controller()
 
-    cmd = [CMD_WRITEMEM, profile, 0, 0, 32]
-    for ch in name:
-        n = ord(ch)
-        cmd.append(n & 255)
-        cmd.append((n >> 8) & 255)
+# Returns the 32 bytes of profile memory that hold <name>
+def encode_name(name: str) -> bytes:
+    data = name.encode("utf-16-le")
+    return data + bytes(32 - len(data))
 
-    while len(cmd) < 37:
-        cmd.append(0)
 
-    send(dev, cmd)
-    expect(dev, REPLY_DONE)
+# <name> must have been checked with check_name(), before the device was claimed
+def rename_profile_ex(dev, profile: int, name: str):
+    update_ex(dev, profile, 0, encode_name(name))
 
-    release_controller(dev)
 
+# Settings of a profile decoded from its memory (see "Profile memory layout" in
+# hori_gip_reverse_eng.md).
+#   name: profile name
+#   volume: headset volume 0..100
+#   balance: in-game volume (0) vs. voice chat (100)
+#   mic: True if the microphone is enabled
+#   mic_sensitivity: 0 (lowest)..4 (highest)
+#   dpad: DPad dead zones
+#   buttons: dict that maps each button (see BUTTONS) to the function it transmits
+#   stick: "LS" or "RS"
+Profile = collections.namedtuple(
+    "Profile", "name volume balance mic mic_sensitivity dpad buttons stick")
 
-def print_profile_name(profile: int):
-    dev = get_controller()
-    print_profile_name_ex(dev, profile)
-    release_controller(dev)
+# D-Pad dead zones (0x3f, 0x4d, 0x5b, 0x69 for the cardinals, 0x34, 0x31, 0x33, 0x32 for the
+# diagonals) and whether balanced mode (0x35) is on.
+DPad = collections.namedtuple("DPad",
+                              "up down left right upleft upright downleft downright balanced")
 
+# Offsets of the DPad fields in profile memory
+DPAD_OFS = DPad(0x3f, 0x4d, 0x5b, 0x69, 0x34, 0x31, 0x33, 0x32, 0x35)
 
-def print_profile_name_ex(dev: usb.core.Device, profile: int):
-    send(dev, (CMD_READMEM, profile, 0, 0, 32))
-    name_utf16 = expect(dev, REPLY_MEM, 36)[4:]
-    name = ""
+# The dead zones the HDM sets for balanced mode
+DPAD_DEFAULT = DPad(0x01, 0x01, 0x01, 0x01, 0x20, 0x20, 0x20, 0x20, True)
 
-    for i in range(16):
-        n = (name_utf16[2 * i + 1] << 8) + name_utf16[2 * i]
-        if n == 0:
-            break
-        name += chr(n)
+# Valid dead zones of the cardinals and the diagonals
+DPAD_CARDINAL_RANGE = (0, 228)
+DPAD_DIAGONAL_RANGE = (30, 255)
 
-    print(f"{profile}: {name}")
+# Offsets and valid values of the audio settings of a Profile
+AUDIO_FIELDS = {
+    "volume": (0x29, 0, 100),
+    "balance": (0x2a, 0, 100),
+    "mic_sensitivity": (0x2c, 0, 4),
+}
 
 
-def print_profile_names():
-    dev = get_controller()
+def decode_profile(image: typing.Sequence[int]) -> Profile:
+    name = decode_name(image)
+    dpad = decode_dpad(image)
+
+    buttons = {}
+    for button, ofs in BUTTONS:
+        if image[ofs] == 4 and image[ofs + 6] == 1:  # override active
+            buttons[button] = CODE2FUNCTION.get(image[ofs + 7], "DISABLED")
+        else:
+            buttons[button] = button
+
+    stick = decode_stick(image[0x18a:0x18a + len(STICK_RS)])
+    return Profile(name, image[0x29], image[0x2a], image[0x2b] == 0, image[0x2c], dpad, buttons,
+                   stick)
+
+
+# Returns the name from the first 32 bytes of profile memory <data>
+def decode_name(data: typing.Sequence[int]) -> str:
+    length = 0
+    while length < 32 and (data[length] != 0 or data[length + 1] != 0):
+        length += 2
+    return bytes(data[0:length]).decode("utf-16-le", errors="replace")
+
+
+# Returns "LS" or "RS" from the bytes of profile memory at 0x18a
+def decode_stick(data: typing.Sequence[int]) -> str:
+    return "RS" if bytes(data) == STICK_RS else "LS"
+
+
+# Returns the DPad from profile memory <data> that starts at offset <base>
+def decode_dpad(data: typing.Sequence[int], base: int = 0) -> DPad:
+    return DPad(*(data[ofs - base] for ofs in DPAD_OFS[:-1]), data[DPAD_OFS.balanced - base] == 0)
+
+
+# Returns the bytes of profile memory that encode <dpad> as dict that maps offsets to values
+def dpad_fields(dpad: DPad) -> dict:
+    fields = dict(zip(DPAD_OFS[:-1], dpad[:-1]))
+    fields[DPAD_OFS.balanced] = 0 if dpad.balanced else 1
+    return fields
+
+
+# Returns a copy of the profile memory <image> with the <settings> applied, which is a dict
+# with some of the fields of a Profile as returned by check_settings(). Buttons mapped to
+# the function they transmit by default get the default mapping. Fields whose decoded value
+# already matches are left unchanged, even if they are encoded differently (e.g. a button
+# that is overridden with its own function).
+def encode_profile(image: typing.Sequence[int], settings: dict) -> bytearray:
+    current = decode_profile(image)
+    image = bytearray(image)
+    if "name" in settings and settings["name"] != current.name:
+        image[0:32] = encode_name(settings["name"])
+    for field, (ofs, _, _) in AUDIO_FIELDS.items():
+        if field in settings:
+            image[ofs] = settings[field]
+    if "mic" in settings and settings["mic"] != current.mic:
+        image[0x2b] = 0 if settings["mic"] else 1
+    if "dpad" in settings:
+        dpad = current.dpad._replace(**settings["dpad"])
+        fields = dpad_fields(dpad)
+        for field, ofs in zip(DPad._fields, DPAD_OFS):
+            if getattr(dpad, field) != getattr(current.dpad, field):
+                image[ofs] = fields[ofs]
+    for button, function in settings.get("buttons", {}).items():
+        ofs = BUTTON2OFS[button]
+        code = FUNCTION2CODE[function]
+        if code == FUNCTION2CODE.get(current.buttons[button]):
+            continue
+        if code == FUNCTION2CODE.get(button):
+            image[ofs:ofs + 8] = PROFILE_DEFAULT[ofs - 0x20:ofs - 0x20 + 8]
+        else:
+            image[ofs:ofs + 8] = bytes([4, 0, 0, 0, 0, 0, 1, code])
+    if "stick" in settings and settings["stick"] != current.stick:
+        image[0x18a:0x19c] = STICK_LS if settings["stick"] == "LS" else STICK_RS
+    return image
+
+
+# Returns the decoded settings of <profile> from the shadow copy of its memory.
+def profile_settings(dev, profile: int) -> Profile:
+    return decode_profile(profile_image(dev, profile))
+
+
+def settings_json(profile: int, settings: Profile) -> dict:
+    result = {"profile": profile}
+    result.update(settings._asdict())
+    result["dpad"] = settings.dpad._asdict()
+    return result
+
+
+def print_json(obj):
+    import json
+    print(json.dumps(obj, indent=2))
+
+
+def print_profile_name_ex(dev: usb.core.Device, profile: int):
+    print(f"{profile}: {decode_name(read_span_ex(dev, profile, 0, 31))}")
+
+
+def print_profile_names_ex(dev):
     print_profile_name_ex(dev, 1)
     print_profile_name_ex(dev, 2)
     print_profile_name_ex(dev, 3)
     print_profile_name_ex(dev, 4)
-    release_controller(dev)
 
 
 def check_mappings(args):
@@ -357,228 +1132,928 @@ def check_mappings(args):
     return mappings
 
 
-def map_buttons(profile, mappings):
-    dev = get_controller()
-
+def map_buttons_ex(dev, profile, mappings):
+    end = 0x20 + len(PROFILE_DEFAULT)
+    mem = bytearray(profile_image(dev, profile))
     for m in mappings:
         ofs, code = m
         if ofs == 0:
-            write_ex(dev, profile, 0x73, PROFILE_DEFAULT[0x73 - 0x20:])
+            mem[0x73:end] = PROFILE_DEFAULT[0x73 - 0x20:]
         else:
-            cmd = [CMD_WRITEMEM, profile, ofs >> 8, ofs & 255, 8, 4, 0, 0, 0, 0, 0, 1, code]
-            send(dev, cmd)
-            expect(dev, REPLY_DONE)
-
-    release_controller(dev)
-
-
-def print_mappings(profile):
-    dev = get_controller()
-    print_mappings_ex(dev, profile)
-    release_controller(dev)
-
+            mem[ofs:ofs + 8] = bytes([4, 0, 0, 0, 0, 0, 1, code])
 
-def print_mappings_ex(dev, profile):
-    ofs = 0x73
-    sz = 0x185 - 0x73
-
-    bigblocks = sz // 55
-    rest = sz % 55
-    result = []
+    update_ex(dev, profile, 0x73, mem[0x73:end])
 
-    for b in range(0, bigblocks):
-        start = b * 55 + ofs
-        send(dev, (CMD_READMEM, profile, start >> 8, start & 255, 55))
-        result.extend(expect(dev, REPLY_MEM, 59)[4:])
 
-    if rest > 0:
-        start = bigblocks * 55 + ofs
-        send(dev, (CMD_READMEM, profile, start >> 8, start & 255, rest))
-        result.extend(expect(dev, REPLY_MEM, rest + 4)[4:])
-
-    prev_bofs = 0
-    for button, bofs in BUTTON2OFS.items():
-        if bofs == prev_bofs:  # Skip entry with same offset but different name
-            continue
-        prev_bofs = bofs
-
-        bofs -= ofs
-        function = button
-        if result[bofs] == 4 and result[bofs + 6] == 1:  # override active
-            function = "DISABLED"
-            code = result[bofs + 7]
-            for f, c in FUNCTION2CODE.items():
-                if c == code:
-                    function = f
+def print_mappings_ex(dev, profile, as_json=False):
+    buttons = profile_settings(dev, profile).buttons
+    if as_json:
+        print_json({"profile": profile, "buttons": buttons})
+        return
+    for button, function in buttons.items():
         print(f"{button}: {function}")
 
 
-def set_stick(profile, stick):
+def check_stick(stick: str):
     stick = stick.upper()
     if stick != "LS" and stick != "RS":
         sys.stderr.write(f"<stick> must be \"LS\" or \"RS\"\n")
         sys.exit(1)
+    return stick
 
-    dev = get_controller()
 
-    if stick == "LS":
-        cmd = [
-            CMD_WRITEMEM, profile, 1, 0x8a, 18, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0
-        ]
-    else:
-        cmd = [
-            CMD_WRITEMEM, profile, 1, 0x8a, 18, 1, 0, 0, 1, 0, 0, 2, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 1
-        ]
+# <stick> must have been checked with check_stick(), before the device was claimed
+def set_stick_ex(dev, profile, stick):
+    update_ex(dev, profile, 0x18a, STICK_LS if stick == "LS" else STICK_RS)
 
-    send(dev, cmd)
-    expect(dev, REPLY_DONE)
 
-    release_controller(dev)
+def print_profile_stick_ex(dev, profile):
+    data = read_span_ex(dev, profile, 0x18a, 0x18a + len(STICK_RS) - 1)
+    print(f"stick: {decode_stick(data)}")
 
 
-def print_profile_stick(profile):
-    dev = get_controller()
-    print_profile_stick_ex(dev, profile)
-    release_controller(dev)
+def format_dpad(dpad: DPad) -> str:
+    return (",".join(str(v) for v in dpad[:-1]) +
+            f" (balanced mode {'on' if dpad.balanced else 'off'})")
 
 
-def print_profile_stick_ex(dev, profile):
-    send(dev, (CMD_READMEM, profile, 1, 0x8a, 18))
-    result = expect(dev, REPLY_MEM, 22)[4:]
-    if bytes(result) == bytes([1, 0, 0, 1, 0, 0, 2, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 1]):
-        print("stick: RS")
-    else:
-        print("stick: LS")
+# Sets the D-Pad dead zones of <profile> to <dpad> and prints them
+def set_dpad_ex(dev, profile, dpad):
+    first, data = write_fields_ex(dev, profile, dpad_fields(dpad))
+    print(f"dpad: {format_dpad(decode_dpad(data, first))}")
+
+
+def print_profile_dpad_ex(dev, profile):
+    first = min(DPAD_OFS)
+    data = read_span_ex(dev, profile, first, max(DPAD_OFS))
+    print(f"dpad: {format_dpad(decode_dpad(data, first))}")
+
+
+# Checks the dpad command's argument "default" or <up>,<down>,<left>,<right>,<upleft>,
+# <upright>,<downleft>,<downright> and returns the DPad. Explicit dead zones switch balanced
+# mode off.
+def check_dpad(arg: str) -> DPad:
+    if arg.lower() == "default":
+        return DPAD_DEFAULT
+    try:
+        values = [int(v, 0) for v in arg.split(",")]
+    except ValueError:
+        values = []
+    if len(values) != 8:
+        sys.stderr.write(f"Incorrect D-Pad dead zones (must be \"default\" or 8 numbers separated "
+                         f"by commas): {arg}\n")
+        sys.exit(1)
+    for field, v in zip(DPad._fields, values[:4]):
+        check_int(v, field, *DPAD_CARDINAL_RANGE)
+    for field, v in zip(DPad._fields[4:], values[4:]):
+        check_int(v, field, *DPAD_DIAGONAL_RANGE)
+    return DPad(*values, False)
 
 
 def devices():
-    device_list = get_devices()
-    for idx, d in enumerate(device_list):
-        vend, prod, bus, addr = d
-        dev = usb.core.find(idVendor=vend, idProduct=prod, bus=bus, address=addr)
+    get_devices()
+    for idx, dev in enumerate(found_devices):
         print(f"{idx}: {dev.manufacturer} {dev.product}")
 
 
-def info():
-    dev = get_controller()
-    for i in (1, 2, 3, 4):
+# Queries all supported devices at the same time, one thread per device, and prints for each
+# of them the firmware version, the active profile and the SHA-256 of the memory of each
+# profile, as table, as JSON (<fmt> "json") or as CSV (<fmt> "csv"). If <reference> is a
+# snapshot returned by read_backup(), the differences from it are listed as drift.
+# Returns the number of devices that could not be queried or differ from <reference>.
+def inventory(fmt="text", reference=None):
+    import hashlib
+    from concurrent.futures import ThreadPoolExecutor
+
+    def query(num):
+        dev = found_devices[num]
+        try:
+            ident = dev.serial_number
+        except:
+            ident = None
+        entry = {"device": num, "bus": dev.bus, "address": dev.address, "serial": ident}
+        start = time.perf_counter()
+        try:
+            dev = get_controller(num)
+            try:
+                active = transact(dev, (CMD_GET_PROFILE, ), REPLY_PROFILE, 2)[0]
+                firmware = get_firmware_version_ex(dev)
+                images = read_ranges_ex(dev, [(p, 0, PROFILE_MEM_SIZE) for p in (1, 2, 3, 4)])
+            finally:
+                release_controller(dev)
+        except (HoriError, OSError) as err:
+            entry["error"] = str(err)
+            return entry
+
+        entry["firmware"] = firmware
+        entry["active"] = active
+        entry["profiles"] = [hashlib.sha256(image).hexdigest() for image in images]
+        entry["time"] = time.perf_counter() - start
+        if reference is not None:
+            ref_active, ref_firmware, ref_images = reference
+            drift = []
+            if firmware != ref_firmware:
+                drift.append("firmware")
+            if active != ref_active:
+                drift.append("active")
+            drift.extend(f"profile {p}" for p, image, ref in zip((1, 2, 3, 4), images, ref_images)
+                         if bytes(image) != bytes(ref))
+            entry["drift"] = drift
+        return entry
+
+    get_devices()
+    start = time.perf_counter()
+    if len(found_devices) > 0:
+        with ThreadPoolExecutor(max_workers=len(found_devices)) as pool:
+            entries = list(pool.map(query, range(len(found_devices))))
+    else:
+        entries = []
+    elapsed = time.perf_counter() - start
+
+    if fmt == "json":
+        print_json(entries)
+    elif fmt == "csv":
+        import csv
+        out = csv.writer(sys.stdout)
+        out.writerow(["device", "bus", "address", "serial", "firmware", "active", "profile1",
+                      "profile2", "profile3", "profile4", "drift", "error"])
+        for e in entries:
+            out.writerow([e["device"], e["bus"], e["address"], e["serial"] or "",
+                          e.get("firmware", ""), e.get("active", "")] +
+                         e.get("profiles", [""] * 4) +
+                         [";".join(e.get("drift", [])),
+                          e.get("error", "")])
+    else:
+        print(f"{'num':>3} {'bus':>3} {'addr':>4} {'serial':12} {'firmware':10} {'active':>6}  "
+              f"{'profile 1':12} {'profile 2':12} {'profile 3':12} profile 4")
+        for e in entries:
+            line = f"{e['device']:3} {e['bus']:3} {e['address']:4} {e['serial'] or '-':12} "
+            if "error" in e:
+                print(f"{line}error: {e['error']}")
+                continue
+            line += f"{e['firmware']:10} {e['active']:6} "
+            line += " ".join(f" {h[:12]}" for h in e["profiles"])
+            if reference is not None:
+                line += "  " + ("drift: " + ", ".join(e["drift"]) if e["drift"] else "ok")
+            print(line)
+    sys.stderr.write(f"Queried {len(entries)} devices in {elapsed * 1000:.1f} ms\n")
+    return sum(1 for e in entries if "error" in e or len(e.get("drift", [])) > 0)
+
+
+def info_ex(dev, as_json=False):
+    profiles = (1, 2, 3, 4)
+    settings = [decode_profile(image) for image in profile_images(dev, profiles)]
+    if as_json:
+        print_json([settings_json(p, s) for p, s in zip(profiles, settings)])
+        return
+    for p, s in zip(profiles, settings):
         print("==============================================")
-        print_profile_name_ex(dev, i)
-        print_mappings_ex(dev, i)
-        print_profile_stick_ex(dev, i)
+        print(f"{p}: {s.name}")
+        for button, function in s.buttons.items():
+            print(f"{button}: {function}")
+        print(f"stick: {s.stick}")
+
+
+# Returns the string the controller reports in reply to CMD_GET_VERSION. It is not the
+# firmware version shown by the HDM (see hori_gip_reverse_eng.md).
+def get_firmware_version_ex(dev) -> str:
+    data = transact(dev, (CMD_GET_VERSION, ), REPLY_VERSION, None)
+    data = bytes(data[:len(data) & ~1])
+    return data.decode("utf-16-le", errors="replace").split("\0")[0]
+
+
+# A backup file starts with BACKUP_MAGIC, the format version, the active profile, the number
+# of profiles, the size of a profile image (big endian) and the length of the firmware
+# version string, followed by the UTF-8 encoded firmware version string, the profile images
+# and the CRC-32 (big endian) of all preceding bytes.
+BACKUP_MAGIC = b"HORI"
+BACKUP_VERSION = 1
+BACKUP_HEADER = ">4sBBBHB"
+
+
+def backup_ex(dev, path: str):
+    import struct
+    import zlib
+
+    active = transact(dev, (CMD_GET_PROFILE, ), REPLY_PROFILE, 2)[0]
+    firmware = get_firmware_version_ex(dev).encode()
+    # All 4 profiles in one pipelined sweep. This also refreshes the shadow copies.
+    images = read_ranges_ex(dev, [(p, 0, PROFILE_MEM_SIZE) for p in (1, 2, 3, 4)])
+
+    data = bytearray(
+        struct.pack(BACKUP_HEADER, BACKUP_MAGIC, BACKUP_VERSION, active, len(images),
+                    PROFILE_MEM_SIZE, len(firmware)))
+    data.extend(firmware)
+    for image in images:
+        data.extend(image)
+    data.extend(struct.pack(">I", zlib.crc32(data)))
 
-    release_controller(dev)
+    try:
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+    except OSError as err:
+        raise HoriError(str(err))
+    print(f"Saved profiles 1-4 (active profile {active}, firmware {firmware.decode()}) "
+          f"to {path}")
 
 
-def check_profile(profile):
-    if profile < 1 or profile > 4:
-        sys.stderr.write("<profile> must be between 1 and 4\n")
-        sys.exit(1)
-    return profile
+# Reads and checks the backup file <path> and returns (active profile, firmware version,
+# list of the profile images).
+def read_backup(path: str):
+    import struct
+    import zlib
 
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError as err:
+        sys.stderr.write(f"{err}\n")
+        sys.exit(1)
 
-if __name__ == "__main__":
-    if len(sys.argv) > 2 and sys.argv[1] == "-d":
-        try:
-            devnum = int(sys.argv[2], 10)
-            sys.argv = sys.argv[2:]
-        except:
-            sys.stderr.write(f"Not a number: {sys.argv[2]}\n")
-            sys.exit(1)
+    hsize = struct.calcsize(BACKUP_HEADER)
+    if len(data) < hsize + 4 or data[:len(BACKUP_MAGIC)] != BACKUP_MAGIC:
+        sys.stderr.write(f"Not a backup file: {path}\n")
+        sys.exit(1)
+    _, version, active, count, size, fwlen = struct.unpack(BACKUP_HEADER, data[:hsize])
+    if version != BACKUP_VERSION:
+        sys.stderr.write(f"Unsupported backup file version: {version}\n")
+        sys.exit(1)
+    if count != 4 or size != PROFILE_MEM_SIZE or len(data) != hsize + fwlen + count * size + 4:
+        sys.stderr.write(f"Corrupt backup file: {path}\n")
+        sys.exit(1)
+    if struct.unpack(">I", data[-4:])[0] != zlib.crc32(data[:-4]):
+        sys.stderr.write(f"Checksum mismatch in backup file: {path}\n")
+        sys.exit(1)
 
-    if len(sys.argv) < 2:
-        sys.stderr.write('''Usage: hori.py [-d <num>] <command> [<args>...]
+    firmware = data[hsize:hsize + fwlen].decode(errors="replace")
+    start = hsize + fwlen
+    images = [data[start + i * size:start + (i + 1) * size] for i in range(count)]
+    return active, firmware, images
+
+
+# Writes the profile images of <snapshot> (as returned by read_backup()) to the controller
+# and activates the profile that was active when the backup was made. Only the bytes that
+# differ from the controller's memory are written.
+def restore_ex(dev, snapshot):
+    active, firmware, images = snapshot
+    current = get_firmware_version_ex(dev)
+    if current != firmware:
+        sys.stderr.write(f"Warning: Backup was made with firmware {firmware}, "
+                         f"controller has firmware {current}\n")
+
+    live = profile_images(dev, (1, 2, 3, 4))
+    for p, image, old in zip((1, 2, 3, 4), images, live):
+        changed = sum(1 for a, b in zip(image, old) if a != b)
+        print(f"Restoring profile {p} ({changed} bytes changed)")
+        update_ex(dev, p, 0, image)
+
+    if transact(dev, (CMD_GET_PROFILE, ), REPLY_PROFILE, 2)[0] != active:
+        activate_profile_ex(dev, active)
+
+
+# Reads the desired state of the controller from the JSON or TOML (if <path> ends in .toml)
+# file <path>. The file contains a list of profiles in the format of "info --json" (JSON
+# only), or an object (table) with the optional key "active" (the profile to activate) and
+# the key "profiles" with such a list. Fields that are missing from a profile are left
+# unchanged. Returns {"active": <profile or None>, "profiles": [(profile, settings), ...]}.
+def read_settings_file(path: str):
+    try:
+        with open(path, "rb") as f:
+            if path.endswith(".toml"):
+                try:
+                    import tomllib
+                except ImportError:
+                    sys.stderr.write("Reading TOML files needs Python 3.11 or later\n")
+                    sys.exit(1)
+                obj = tomllib.load(f)
+            else:
+                import json
+                obj = json.load(f)
+    except OSError as err:
+        sys.stderr.write(f"{err}\n")
+        sys.exit(1)
+    except ValueError as err:  # json.JSONDecodeError and tomllib.TOMLDecodeError
+        sys.stderr.write(f"Error parsing {path}: {err}\n")
+        sys.exit(1)
 
--d <num>
-  Select the device to operate on, if multiple supported devices are
-  connected to the computer.
+    if isinstance(obj, list):
+        obj = {"profiles": obj}
+    if not isinstance(obj, dict) or not isinstance(obj.get("profiles", []), list):
+        sys.stderr.write(f"{path}: Expected a list of profiles\n")
+        sys.exit(1)
+    unknown = set(obj) - {"active", "profiles"}
+    if len(unknown) > 0:
+        sys.stderr.write(f"{path}: Unknown key: {unknown.pop()}\n")
+        sys.exit(1)
 
-devices
-  Lists all devices supported by this program, together with the <num>
-  for use with -d.
+    active = obj.get("active")
+    if active is not None:
+        active = check_int(active, "active", 1, 4)
+    profiles = []
+    for settings in obj.get("profiles", []):
+        profile, settings = check_settings(settings)
+        if any(p == profile for p, _ in profiles):
+            sys.stderr.write(f"{path}: Profile {profile} is listed twice\n")
+            sys.exit(1)
+        profiles.append((profile, settings))
+    return {"active": active, "profiles": profiles}
 
-hexdump <profile> [<ofs> [<size>]]
-  Dump <size> bytes starting at <ofs> of config memory for <profile>
 
-write <profile> <ofs> <data>
-  Write <data> bytes to config memory of <profile> starting at <ofs>
+def check_int(value, field: str, lo: int, hi: int) -> int:
+    if isinstance(value, bool) or not isinstance(value, int) or value < lo or value > hi:
+        sys.stderr.write(f"{field} must be a number between {lo} and {hi}: {value}\n")
+        sys.exit(1)
+    return value
 
-profile [<profile>]
-  With no argument, print out currently active profile.
-  With argument, make <profile> active.
 
-name [<profile> [<name>]]
-  With no arguments, lists the names of all profiles.
-  With only <profile> as argument, lists that profile's name.
-  With <profile> and <name>, renames <profile>.
+# Checks the settings of a profile read from a file and returns (profile, settings) with
+# button, function and stick names in upper case. Buttons are named as in BUTTONS, e.g.
+# VIEW becomes SELECT.
+def check_settings(obj):
+    if not isinstance(obj, dict) or "profile" not in obj:
+        sys.stderr.write(f"Profile without profile number: {obj}\n")
+        sys.exit(1)
+    profile = check_int(obj["profile"], "profile", 1, 4)
+    settings = {}
+    for field, value in obj.items():
+        where = f"Profile {profile}: {field}"
+        if field == "profile":
+            continue
+        elif field == "name":
+            if not isinstance(value, str):
+                sys.stderr.write(f"{where} must be a string\n")
+                sys.exit(1)
+            settings[field] = check_name(value)
+        elif field in AUDIO_FIELDS:
+            settings[field] = check_int(value, where, *AUDIO_FIELDS[field][1:])
+        elif field == "mic":
+            if not isinstance(value, bool):
+                sys.stderr.write(f"{where} must be true or false\n")
+                sys.exit(1)
+            settings[field] = value
+        elif field == "stick":
+            settings[field] = check_stick(str(value))
+        elif field == "dpad" and isinstance(value, dict):
+            dpad = {}
+            for direction, v in value.items():
+                if direction == "balanced" and isinstance(v, bool):
+                    dpad[direction] = v
+                elif direction in ("up", "down", "left", "right"):
+                    dpad[direction] = check_int(v, f"{where}.{direction}", *DPAD_CARDINAL_RANGE)
+                elif direction in DPad._fields[4:8]:
+                    dpad[direction] = check_int(v, f"{where}.{direction}", *DPAD_DIAGONAL_RANGE)
+                else:
+                    sys.stderr.write(f"Invalid {where}.{direction}: {v}\n")
+                    sys.exit(1)
+            settings[field] = dpad
+        elif field == "buttons" and isinstance(value, dict):
+            buttons = {}
+            for button, function in value.items():
+                if button.upper() not in BUTTON2OFS or str(function).upper() not in FUNCTION2CODE:
+                    sys.stderr.write(f"Incorrect mapping in {where}: {button}={function}\n")
+                    sys.exit(1)
+                buttons[OFS2BUTTON[BUTTON2OFS[button.upper()]]] = str(function).upper()
+            settings[field] = buttons
+        else:
+            sys.stderr.write(f"Invalid {where}: {value}\n")
+            sys.exit(1)
+    return profile, settings
+
+
+# Changes the controller to the state <desired> returned by read_settings_file(). The memory
+# of the profiles is read once (unless there are shadow copies) and only the bytes that
+# differ from the desired state are written, so nothing is written if the controller is
+# already in that state. With <dry_run>, only the changes are printed.
+def apply_ex(dev, desired, dry_run=False):
+    profiles = [p for p, _ in desired["profiles"]]
+    for (p, settings), image in zip(desired["profiles"], profile_images(dev, profiles)):
+        target = encode_profile(image, settings)
+        pieces = plan_writes(image, target)
+        if len(pieces) == 0:
+            print(f"Profile {p}: up to date")
+            continue
+        changed = sum(1 for a, b in zip(image, target) if a != b)
+        print(f"Profile {p}: {changed} bytes changed in "
+              f"{', '.join(f'{ofs:#05x}-{ofs + len(data) - 1:#05x}' for ofs, data in pieces)}")
+        if not dry_run:
+            write_pieces_ex(dev, p, pieces)
+
+    active = desired["active"]
+    if active is not None:
+        current = transact(dev, (CMD_GET_PROFILE, ), REPLY_PROFILE, 2)[0]
+        if current != active:
+            print(f"Activating profile {active}")
+            if not dry_run:
+                transact(dev, (CMD_SWITCH_PROFILE, active), REPLY_DONE)
+
+
+class InputMonitor:
+    '''
+    Collects statistics about the input reports of a controller: a histogram of the
+    intervals between reports, the number of reports lost (gaps in the sequence numbers)
+    and the press and hold times of the buttons.
+
+    The times of the last <size> reports are kept in a ring buffer that is allocated up
+    front, so that no memory is allocated per report.
+    '''
+
+    # Upper bounds (in ms) of the bins of the interval histogram. The last bin is open.
+    BINS = (0.5, 1, 2, 4, 8, 16, 32)
+
+    def __init__(self, size: int = 65536):
+        import array
+        import struct
+        self.input = struct.Struct("<HHHhhhh")
+        self.size = size
+        self.times = array.array("d", bytes(8 * size))
+        self.count = 0  # number of reports added, the next one goes to count % size
+        self.histogram = [0] * (len(self.BINS) + 1)
+        self.lost = 0
+        self.seq = None
+        self.last = None  # time of the previous report
+        self.state = 0  # bits of INPUT_BUTTONS that are pressed
+        self.sticks = (0, 0, 0, 0)  # LX, LY, RX, RY of the last report
+        self.pressed = {}  # button -> time it was pressed
+        self.holds = {b: [] for b in INPUT_BUTTONS}  # button -> hold times in s
+
+    # Processes GIP_INPUT and GIP_GUIDE reports. Returns a list of (button, time of press,
+    # hold time or None) for the buttons that were pressed (None) or released.
+    def add(self, t: float, packet: bytes):
+        if packet[0] == GIP_GUIDE and len(packet) >= 5:
+            state = self.state & ~INPUT_BUTTONS["GUIDE"]
+            if packet[4] & 1:
+                state |= INPUT_BUTTONS["GUIDE"]
+            return self.change(t, state)
+
+        if packet[0] != GIP_INPUT or len(packet) < 4 + self.input.size:
+            return []
+        if self.seq is not None and packet[2] != self.seq:
+            gap = (packet[2] - self.seq - 1) % 256
+            if 0 < packet[2] < self.seq:  # wrapped around, 0 is skipped
+                gap -= 1
+            self.lost += gap
+        self.seq = packet[2]
+
+        if self.last is not None:
+            ms = (t - self.last) * 1000
+            b = 0
+            while b < len(self.BINS) and ms >= self.BINS[b]:
+                b += 1
+            self.histogram[b] += 1
+        self.last = t
+
+        buttons, lt, rt, lx, ly, rx, ry = self.input.unpack_from(packet, 4)
+        state = buttons | (self.state & INPUT_BUTTONS["GUIDE"])
+        if lt > 0:
+            state |= INPUT_BUTTONS["LT"]
+        if rt > 0:
+            state |= INPUT_BUTTONS["RT"]
+        self.sticks = (lx, ly, rx, ry)
+
+        i = self.count % self.size
+        self.times[i] = t
+        self.count += 1
+        return self.change(t, state)
+
+    def change(self, t: float, state: int):
+        events = []
+        changed = state ^ self.state
+        if changed:
+            for button, bit in INPUT_BUTTONS.items():
+                if changed & bit:
+                    if state & bit:
+                        self.pressed[button] = t
+                        events.append((button, t, None))
+                    elif button in self.pressed:
+                        start = self.pressed.pop(button)
+                        self.holds[button].append(t - start)
+                        events.append((button, start, t - start))
+        self.state = state
+        return events
+
+    # Returns the intervals (in s) between the reports of the last <seconds> seconds that are
+    # still in the ring buffer.
+    def recent_intervals(self, now: float, seconds: float = 1.0):
+        result = []
+        i = self.count - 1
+        while i > 0 and i > self.count - self.size and self.times[i % self.size] >= now - seconds:
+            result.append(self.times[i % self.size] - self.times[(i - 1) % self.size])
+            i -= 1
+        return sorted(result)
+
+
+# Prints the input reports of the controller for <seconds> seconds (until interrupted if
+# None): button presses and releases, once per second the report rate and latency
+# statistics, and a summary at the end. With <verbose>, every report is printed.
+def monitor_ex(dev, seconds=None, verbose=False):
+    reader = get_reader(dev)
+    mon = InputMonitor()
+    overflows = reader.overflows
+    reader.hold()
+    start = time.monotonic()
+    end = None if seconds is None else start + seconds
+    next_status = start + 1
+    try:
+        while end is None or time.monotonic() < end:
+            report = reader.next_report(next_status if end is None else min(next_status, end))
+            if report is not None:
+                t, packet = report
+                if packet[0] == GIP_REPLY and packet[4] == REPORT_PROFILE:
+                    print(f"{t - start:9.3f} s  profile {packet[5]}")
+                for button, pressed, hold in mon.add(t, packet):
+                    if hold is None:
+                        print(f"{t - start:9.3f} s  {button} pressed")
+                    else:
+                        print(f"{t - start:9.3f} s  {button} released after "
+                              f"{hold * 1000:.1f} ms")
+                if verbose and packet[0] == GIP_INPUT:
+                    print(f"{t - start:9.3f} s  seq {packet[2]:3} buttons {mon.state:05x} "
+                          f"sticks {mon.sticks}")
+
+            now = time.monotonic()
+            if now >= next_status:
+                intervals = mon.recent_intervals(now)
+                line = f"{now - start:9.3f} s  {len(intervals)} reports/s"
+                if len(intervals) > 0:
+                    line += (f", interval p50 {intervals[len(intervals) // 2] * 1000:.2f} ms"
+                             f" p99 {intervals[int(len(intervals) * 0.99)] * 1000:.2f} ms"
+                             f" max {intervals[-1] * 1000:.2f} ms")
+                print(f"{line}, lost {mon.lost}, overflows {reader.overflows - overflows}")
+                next_status = max(next_status + 1, now)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.unhold()
+
+    print("==============================================")
+    print(f"{mon.count} reports, {mon.lost} lost, {reader.overflows - overflows} overflows")
+    lower = 0
+    for bound, n in zip(mon.BINS + (None, ), mon.histogram):
+        label = f"{lower:>4} - {bound:<4} ms" if bound is not None else f"{lower:>4} -      ms"
+        print(f"{label} {n:8}")
+        lower = bound
+    for button, holds in mon.holds.items():
+        if len(holds) > 0:
+            print(f"{button}: {len(holds)} presses, hold time min {min(holds) * 1000:.1f} ms, "
+                  f"mean {sum(holds) / len(holds) * 1000:.1f} ms, max {max(holds) * 1000:.1f} ms")
+
+
+# Returns a function that runs the hook <hook> for the watch command, or None if <hook> is
+# None. "<module>:<function>" is imported from the current directory or the Python path and
+# called with the profile number and its Profile. Everything else is run as shell command
+# with the environment variables HORI_PROFILE, HORI_NAME and HORI_SETTINGS (the Profile
+# as JSON).
+def check_hook(hook):
+    if hook is None:
+        return None
+
+    module, _, function = hook.partition(":")
+    if all(part.isidentifier() for part in module.split(".") + function.split(".")):
+        import importlib
+        if os.getcwd() not in sys.path:
+            sys.path.append(os.getcwd())
+        try:
+            obj = importlib.import_module(module)
+            for part in function.split("."):
+                obj = getattr(obj, part)
+        except (ImportError, AttributeError) as err:
+            sys.stderr.write(f"Invalid hook {hook}: {err}\n")
+            sys.exit(1)
+        return obj
+
+    def run(profile, settings):
+        import json
+        import subprocess
+        env = dict(os.environ)
+        env["HORI_PROFILE"] = str(profile)
+        env["HORI_NAME"] = settings.name
+        env["HORI_SETTINGS"] = json.dumps(settings_json(profile, settings))
+        result = subprocess.run(hook, shell=True, env=env)
+        if result.returncode != 0:
+            raise HoriError(f"exit code {result.returncode}")
+
+    return run
+
+
+# Waits for changes of the active profile with the profile button of the controller until
+# interrupted. For each change, <hook> (see check_hook()) is called with the new profile and
+# its settings, or the profile and its name are printed if <hook> is None. The settings come
+# from the shadow copy of profile memory, so that no request has to be sent to the controller.
+def watch_ex(dev, hook=None):
+    import queue
+
+    changes = queue.Queue()
+
+    def notify(d, profile):
+        if d is dev:
+            changes.put(profile)
+
+    decoded = {}  # profile -> (image, Profile)
+
+    def settings(profile):
+        image = bytes(profile_image(dev, profile))
+        if profile not in decoded or decoded[profile][0] != image:
+            decoded[profile] = (image, decode_profile(image))
+        return decoded[profile][1]
+
+    profile_images(dev, (1, 2, 3, 4))
+    for p in (1, 2, 3, 4):
+        settings(p)
+
+    reader = get_reader(dev)
+    profile_listeners.append(notify)
+    # The reader thread blocks in reads from the controller and wakes up this thread only for
+    # profile changes
+    reader.hold(reports=False)
+    try:
+        while True:
+            profile = changes.get()
+            if profile < 1 or profile > 4:
+                continue
+            s = settings(profile)
+            if hook is None:
+                print(f"{profile}: {s.name}")
+                sys.stdout.flush()
+                continue
+            try:
+                hook(profile, s)
+            except Exception as err:
+                sys.stderr.write(f"Hook failed for profile {profile}: {err}\n")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.unhold(reports=False)
+        profile_listeners.remove(notify)
 
-reset <profile>
-  Reset all values of <profile>, except for the name, to default values.
 
-map <profile> [default] [<button>=<function> ...]
-  If only <profile> is specified, print the current button mappings.
-  If <button>=<function> ... arguments are specified, the respective button
-  mappings are modified. Buttons not listed are left unchanged.
-  If "default" is specified as argument, all button mappings for <profile>
-  are reset to their default values.
+# A recording starts with RECORDING_MAGIC, followed by records of RECORD_FORMAT: the time
+# of arrival in ns since the epoch, the length of the packet and its first 31 bytes.
+RECORDING_MAGIC = b"HORIREC1"
+RECORD_FORMAT = "<QB31s"
 
-stick <profile> [ LS | RS ]
-  If only <profile> is specified, print whether the analog stick of <profile>
-  is configured as LS or RS.
-  If "LS" or "RS" is specified, configure analog stick of <profile> to that.
 
-dpad <profile> [ default | <up>,<down>,<left>,<right>,<upleft>,<upright>,<downleft>,<downright> ]
-  If only <profile> is specified, print out the D-Pad dead zone of <profile>.
-  If "default" is specified, reset the D-Pad dead zone of <profile> to the default.
-  <up>,<down>,<left>,<right> is the dead zone of the cardinals (0 to 228, where 228
-  is the maximum, i.e. you have to press really hard to activate the direction).
-  <upleft>,<upright>,<downleft>,<downright> is the dead zone of the diagonals
-  (30 to 255, where 255 is the maximum).
+# Appends the packets the controller sends on its own (input reports, profile changes) to
+# the recording <path> for <seconds> seconds (until interrupted if None).
+def record_ex(dev, path, seconds=None):
+    import struct
+    rec = struct.Struct(RECORD_FORMAT)
 
-info
-  Print out all information that can be extracted from the controller.
+    reader = get_reader(dev)
+    overflows = reader.overflows
+    count = 0
+    try:
+        f = open(path, "ab")
+    except OSError as err:
+        raise HoriError(str(err))
+    with f:
+        if f.tell() == 0:
+            f.write(RECORDING_MAGIC)
+        # Reports are timestamped with time.monotonic(), which is converted to wall clock time
+        offset = time.time_ns() - int(time.monotonic() * 1e9)
+        start = time.monotonic()
+        end = None if seconds is None else start + seconds
+        next_flush = start + 1
+        reader.hold()
+        try:
+            while end is None or time.monotonic() < end:
+                report = reader.next_report(next_flush if end is None else min(next_flush, end))
+                if report is not None:
+                    t, packet = report
+                    f.write(rec.pack(int(t * 1e9) + offset, min(len(packet), 255), packet))
+                    count += 1
+                if time.monotonic() >= next_flush:
+                    f.flush()
+                    next_flush = time.monotonic() + 1
+        except KeyboardInterrupt:
+            pass
+        finally:
+            reader.unhold()
+
+    sys.stderr.write(f"Recorded {count} reports to {path}")
+    if reader.overflows > overflows:
+        sys.stderr.write(f", {reader.overflows - overflows} reports were lost")
+    sys.stderr.write("\n")
+
+
+# Copies the memory of <src_profile> of the device <src> to <dst_profile> of the device
+# <dst>, which may be the same device. Each chunk read from <src> is written to <dst> as
+# soon as it arrives, so the reads and writes overlap instead of taking two sweeps. On the
+# same device, the writes only start after the reads, because both would have to share
+# the PIPELINE_DEPTH requests in flight, which makes the writes slower than the time the
+# overlap saves. Chunks that already match the shadow copy of <dst_profile> (if there is
+# one) are not written. With <keep_name>, the name of <dst_profile> is left unchanged. With
+# <verify>, the memory of <dst_profile> is read back and compared. Returns the number of
+# bytes written.
+def copy_ex(src, src_profile, dst, dst_profile, keep_name=False, verify=False):
+    import itertools
+    import queue
+
+    ofs = 0x20 if keep_name else 0
+    sz = PROFILE_MEM_SIZE - ofs
+    reads = [(CMD_READMEM, src_profile, start >> 8, start & 255, n)
+             for start, n in chunks(ofs, sz)]
+    data = bytearray(sz)
+    known = shadow.get(dst, {}).get(dst_profile)
+    writes = queue.Queue()
+    errors = []
+    written = 0
+
+    def write():
+        try:
+            for _ in pipeline(dst, iter(writes.get, None), REPLY_DONE, itertools.repeat(0)):
+                pass
+        except Exception as err:
+            errors.append(err)
+
+    writer = threading.Thread(target=write, daemon=True)
+    if src is not dst:
+        writer.start()
+    try:
+        for _, reply in pipeline(src, reads, REPLY_MEM, [cmd[4] + 4 for cmd in reads]):
+            start = (reply[1] << 8) + reply[2]
+            chunk = reply[4:4 + reply[3]]
+            data[start - ofs:start - ofs + len(chunk)] = chunk
+            if known is not None and known[start:start + len(chunk)] == chunk:
+                continue
+            writes.put([CMD_WRITEMEM, dst_profile, start >> 8, start & 255, len(chunk)] +
+                       list(chunk))
+            written += len(chunk)
+    finally:
+        writes.put(None)
+        if writer.is_alive():
+            writer.join()
+    if src is dst:
+        writer.start()
+        writer.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+    for dev, profile in ((src, src_profile), (dst, dst_profile)):
+        if ofs == 0:
+            # The whole memory of the profile is known now
+            shadow.setdefault(dev, {})[profile] = bytearray(data)
+            shadow_unverified.get(dev, set()).discard(profile)
+        else:
+            update_shadow(dev, profile, ofs, data)
+
+    if verify:
+        check = read_ex(dst, dst_profile, ofs, sz)
+        diff = [i for i in range(sz) if check[i] != data[i]]
+        if len(diff) > 0:
+            raise HoriError(f"Verification failed: {len(diff)} bytes differ, the first one "
+                            f"at offset {hex(ofs + diff[0])}")
+    return written
+
+
+# Sends make(start, count), which returns (command, payload size of the reply), for each
+# chunk of the <sz> bytes at <ofs> and returns the sorted list of (start, count, payload)
+# with the payload of the reply of type <reply> or None. Chunks that are not answered are
+# split in halves and probed again, down to single bytes.
+def probe_regions(dev, ofs: int, sz: int, reply: int, make, chunk: int = CHUNK_SIZE):
+    result = []
+    todo = [(start, min(chunk, ofs + sz - start)) for start in range(ofs, ofs + sz, chunk)]
+    while len(todo) > 0:
+        probes = [make(start, n) for start, n in todo]
+        retry = []
+        for idx, data in pipeline(dev, [p[0] for p in probes],
+                                  reply, [p[1] for p in probes],
+                                  missing_ok=True):
+            start, n = todo[idx]
+            if data is not None or n == 1:
+                result.append((start, n, data))
+            else:
+                retry.extend([(start, n // 2), (start + n // 2, n - n // 2)])
+        todo = retry
+    return sorted(result, key=lambda r: r[0])
+
+
+# Returns the lowest value in (<lo>, <hi>) for which <probe>(value), which returns a command
+# and the payload size of its reply, is not answered with <reply>, or <hi> if all are
+# answered. <probe>(<lo>) must be answered. Each round probes PIPELINE_DEPTH values at once
+# and narrows the range to the interval between the last one answered and the first one not
+# answered, so requests beyond the end only cost one reply_timeout per round.
+def probe_limit(dev, lo: int, hi: int, reply: int, probe):
+    while hi - lo > 1:
+        values = sorted({lo + (hi - lo) * (i + 1) // (PIPELINE_DEPTH + 1)
+                         for i in range(PIPELINE_DEPTH)} - {lo, hi})
+        probes = [probe(v) for v in values]
+        answered = [False] * len(values)
+        for idx, data in pipeline(dev, [p[0] for p in probes], reply, [p[1] for p in probes],
+                                  missing_ok=True):
+            answered[idx] = data is not None
+        for v, ok in zip(values, answered):
+            if not ok:
+                hi = v
+                break
+            lo = v
+    return hi
+
+
+# Formats a list of numbers as comma separated ranges, e.g. "0, 5-255"
+def number_ranges(numbers):
+    parts = []
+    for n in numbers:
+        if len(parts) > 0 and parts[-1][1] == n - 1:
+            parts[-1][1] = n
+        else:
+            parts.append([n, n])
+    return ", ".join(str(a) if a == b else f"{a}-{b}" for a, b in parts)
+
+
+# Probes which profile numbers from <first> to <last> the controller answers READMEM for, and
+# for each of them the size of readable memory (assuming that it starts at 0 and is
+# contiguous), the maximum number of bytes per READMEM and the map of the regions that
+# can be read and, with <write>, written. The write probes write back the bytes that have
+# just been read, so profile memory is not changed.
+def scan_ex(dev, first: int = 0, last: int = 255, write: bool = False):
+    ids = list(range(first, last + 1))
+    found = [False] * len(ids)
+    for idx, data in pipeline(dev, [(CMD_READMEM, p, 0, 0, 1) for p in ids], REPLY_MEM,
+                              [5] * len(ids), missing_ok=True):
+        found[idx] = data is not None
+    profiles = [p for p, ok in zip(ids, found) if ok]
+
+    for p in profiles:
+        end = probe_limit(dev, 0, 0x10000, REPLY_MEM,
+                          lambda ofs: ((CMD_READMEM, p, ofs >> 8, ofs & 255, 1), 5))
+        maxcount = probe_limit(dev, 1, min(256, end + 1), REPLY_MEM,
+                               lambda n: ((CMD_READMEM, p, 0, 0, n), n + 4)) - 1
+        print(f"Profile {p}: {end} bytes (0x0000-{end - 1:#06x}), "
+              f"at most {maxcount} bytes per READMEM")
+
+        reads = probe_regions(dev, 0, end, REPLY_MEM,
+                              lambda start, n: ((CMD_READMEM, p, start >> 8, start & 255, n),
+                                                n + 4), maxcount)
+        regions = []  # [start, end, description]
+        for start, n, data in reads:
+            access = "not readable"
+            if data is not None:
+                access = "read"
+                if write:
+                    content = list(data[4:4 + n])
+                    writes = probe_regions(
+                        dev, start, n, REPLY_DONE, lambda ws, wn:
+                        ([CMD_WRITEMEM, p, ws >> 8, ws & 255, wn] +
+                         content[ws - start:ws - start + wn], 0), maxcount)
+                    for ws, wn, ack in writes:
+                        desc = "read, write" if ack is not None else "read only"
+                        if len(regions) > 0 and regions[-1][1] == ws and regions[-1][2] == desc:
+                            regions[-1][1] = ws + wn
+                        else:
+                            regions.append([ws, ws + wn, desc])
+                    continue
+            if len(regions) > 0 and regions[-1][1] == start and regions[-1][2] == access:
+                regions[-1][1] = start + n
+            else:
+                regions.append([start, start + n, access])
+        for start, stop, desc in regions:
+            print(f"  {start:#06x}-{stop - 1:#06x}  {desc}")
+
+    missing = [p for p, ok in zip(ids, found) if not ok]
+    if len(missing) > 0:
+        print(f"No reply for profile {number_ranges(missing)}")
+
+
+# Parses <arg> of the form [<num>:]<profile> and returns (device number, profile)
+def check_location(arg: str):
+    num, _, profile = arg.rpartition(":")
+    try:
+        return int(num, 10) if num != "" else devnum, check_profile(int(profile, 0))
+    except ValueError:
+        sys.stderr.write(f"Incorrect argument (must be [<num>:]<profile>): {arg}\n")
+        sys.exit(1)
 
-<profile> 1..4
-<ofs> 0..
-<size> 1..
-<data> Sequence of numbers in range 0..255
-<name> String with maximum of 16 characters
-<button> is the name of a button as printed on the controller. The names of
-         the special buttons are SELECT/VIEW, GUIDE/XBOX, SHARE, START/MENU.
-         Button names are case-insensitive.
-<function> specifies what the <button> is supposed to transmit to the PC/console
-         when pressed. Available functions are:
-         A, B, X, Y, LB, RB, LT, RT, LSB, RSB,
-         SELECT, VIEW, GUIDE, XBOX, SHARE, START, MENU,
-         DPAD-UP, DPAD-DOWN, DPAD-LEFT, DPAD-RIGHT,
-         LS-UP, LS-DOWN, LS-LEFT, LS-RIGHT,
-         RS-UP, RS-DOWN, RS-LEFT, RS-RIGHT,
-         DISABLED
 
-''')
+def check_profile(profile):
+    if profile < 1 or profile > 4:
+        sys.stderr.write("<profile> must be between 1 and 4\n")
         sys.exit(1)
+    return profile
 
-    check_device()
 
-    cmd = sys.argv[1]
-    if cmd == "devices":
-        devices()
-    elif cmd == "hexdump":
-        if len(sys.argv) < 3:
+# Checks the command line <args> of a command (<args>[0] is the command) and returns a
+# function that executes the command on a device.
+def parse_command(args):
+    cmd = args[0]
+    if cmd == "hexdump":
+        binary = "-b" in args
+        args = [a for a in args if a != "-b"]
+        if len(args) < 2:
             sys.stderr.write("Missing argument: <profile>\n")
             sys.exit(1)
-        if len(sys.argv) > 5:
+        if len(args) > 4:
             sys.stderr.write("Too many arguments\n")
             sys.exit(1)
 
-        profile = check_profile(int(sys.argv[2], 0))
+        profile = check_profile(int(args[1], 0))
 
         start = None
         sz = None
-        if len(sys.argv) > 3:
-            start = int(sys.argv[3], 0)
-        if len(sys.argv) > 4:
-            sz = int(sys.argv[4], 0)
+        if len(args) > 2:
+            start = int(args[2], 0)
+        if len(args) > 3:
+            sz = int(args[3], 0)
 
         if start is not None:
             if start < 0:
@@ -595,23 +2070,23 @@ info
             sz = PROFILE_MEM_SIZE - start
             if sz <= 0: sz = 1
 
-        hexdump(profile, start, sz)
+        return lambda dev: hexdump_ex(dev, profile, start, sz, binary)
 
     elif cmd == "write":
-        if len(sys.argv) < 5:
+        if len(args) < 4:
             sys.stderr.write("USAGE: write <profile> <ofs> <data>\n")
             sys.exit(1)
 
-        profile = check_profile(int(sys.argv[2], 0))
+        profile = check_profile(int(args[1], 0))
 
-        start = int(sys.argv[3], 0)
+        start = int(args[2], 0)
 
         if start < 0:
             sys.stderr.write("<ofs> must be greater equal 0\n")
             sys.exit(1)
 
         try:
-            data = list(map(lambda x: int(x, 0), sys.argv[4:]))
+            data = list(map(lambda x: int(x, 0), args[3:]))
         except ValueError as err:
             sys.stderr.write(f"Error parsing <data>: {str(err)}\n")
             sys.exit(1)
@@ -620,81 +2095,852 @@ info
             sys.stderr.write("All <data> arguments must be between 0 and 255\n")
             sys.exit(1)
 
-        print(f"Writing mem of profile {profile} at offset {hex(start)}: {[hex(x) for x in data]} ")
-        write(profile, start, data)
+        def run(dev):
+            print(f"Writing mem of profile {profile} at offset {hex(start)}: "
+                  f"{[hex(x) for x in data]} ")
+            write_ex(dev, profile, start, data)
+
+        return run
 
     elif cmd == "profile":
-        if len(sys.argv) > 3:
+        if len(args) > 2:
             sys.stderr.write("Too many arguments\n")
             sys.exit(1)
 
-        if len(sys.argv) == 3:
-            profile = check_profile(int(sys.argv[2], 0))
-            activate_profile(profile)
+        profile = None
+        if len(args) == 2:
+            profile = check_profile(int(args[1], 0))
 
-        print_active_profile_number()
+        def run(dev):
+            if profile is not None:
+                activate_profile_ex(dev, profile)
+            print_active_profile_number_ex(dev)
+
+        return run
 
     elif cmd == "map":
-        if len(sys.argv) < 3:
+        if len(args) < 2:
             sys.stderr.write("Need <profile> argument\n")
             sys.exit(1)
 
-        profile = check_profile(int(sys.argv[2], 0))
+        profile = check_profile(int(args[1], 0))
 
-        if len(sys.argv) > 3:
-            mappings = check_mappings(sys.argv[3:])
-            map_buttons(profile, mappings)
+        as_json = "--json" in args
+        args = [a for a in args if a != "--json"]
+        mappings = None
+        if len(args) > 2:
+            mappings = check_mappings(args[2:])
+
+        def run(dev):
+            if mappings is not None:
+                map_buttons_ex(dev, profile, mappings)
+            print_mappings_ex(dev, profile, as_json)
 
-        print_mappings(profile)
+        return run
 
     elif cmd == "reset":
-        if len(sys.argv) > 3:
+        if len(args) > 2:
             sys.stderr.write("Too many arguments\n")
             sys.exit(1)
 
-        if len(sys.argv) < 3:
+        if len(args) < 2:
             sys.stderr.write("Missing profile number\n")
             sys.exit(1)
 
-        profile = check_profile(int(sys.argv[2], 0))
-        reset_profile(profile)
+        profile = check_profile(int(args[1], 0))
+        return lambda dev: reset_profile_ex(dev, profile)
 
     elif cmd == "name":
-        if len(sys.argv) == 2:
-            print_profile_names()
-        else:
-            if len(sys.argv) > 4:
-                sys.stderr.write("Too many arguments\n")
-                sys.exit(1)
+        if len(args) == 1:
+            return print_profile_names_ex
+
+        if len(args) > 3:
+            sys.stderr.write("Too many arguments\n")
+            sys.exit(1)
 
-            profile = check_profile(int(sys.argv[2], 0))
-            if len(sys.argv) == 4:
-                rename_profile(profile, sys.argv[3])
+        profile = check_profile(int(args[1], 0))
+        name = None
+        if len(args) == 3:
+            name = check_name(args[2])
 
-            print_profile_name(profile)
+        def run(dev):
+            if name is not None:
+                rename_profile_ex(dev, profile, name)
+            print_profile_name_ex(dev, profile)
+
+        return run
 
     elif cmd == "stick":
-        if len(sys.argv) > 4:
+        if len(args) > 3:
             sys.stderr.write("Too many arguments\n")
             sys.exit(1)
 
-        if len(sys.argv) < 3:
+        if len(args) < 2:
             sys.stderr.write("Missing profile number\n")
             sys.exit(1)
 
-        profile = check_profile(int(sys.argv[2], 0))
-        if len(sys.argv) == 4:
-            set_stick(profile, sys.argv[3])
+        profile = check_profile(int(args[1], 0))
+        stick = None
+        if len(args) == 3:
+            stick = check_stick(args[2])
+
+        def run(dev):
+            if stick is not None:
+                set_stick_ex(dev, profile, stick)
+            print_profile_stick_ex(dev, profile)
+
+        return run
+
+    elif cmd == "dpad":
+        if len(args) > 3:
+            sys.stderr.write("Too many arguments\n")
+            sys.exit(1)
+
+        if len(args) < 2:
+            sys.stderr.write("Missing profile number\n")
+            sys.exit(1)
 
-        print_profile_stick(profile)
+        profile = check_profile(int(args[1], 0))
+        if len(args) == 3:
+            dpad = check_dpad(args[2])
+            return lambda dev: set_dpad_ex(dev, profile, dpad)
+        return lambda dev: print_profile_dpad_ex(dev, profile)
 
     elif cmd == "info":
-        if len(sys.argv) > 2:
+        if len(args) > 2 or (len(args) == 2 and args[1] != "--json"):
+            sys.stderr.write("Too many arguments\n")
+            sys.exit(1)
+
+        as_json = len(args) == 2
+        return lambda dev: info_ex(dev, as_json)
+
+    elif cmd == "monitor":
+        verbose = "-v" in args
+        args = [a for a in args if a != "-v"]
+        if len(args) > 2:
+            sys.stderr.write("Too many arguments\n")
+            sys.exit(1)
+
+        seconds = None
+        if len(args) == 2:
+            seconds = float(args[1])
+            if seconds <= 0:
+                sys.stderr.write("<seconds> must be greater than 0\n")
+                sys.exit(1)
+        return lambda dev: monitor_ex(dev, seconds, verbose)
+
+    elif cmd == "watch":
+        if len(args) > 2:
+            sys.stderr.write("Too many arguments\n")
+            sys.exit(1)
+
+        # Imported now, so that batch and -d all find a bad hook before claiming the device
+        hook = check_hook(args[1] if len(args) == 2 else None)
+        return lambda dev: watch_ex(dev, hook)
+
+    elif cmd == "record":
+        if len(args) < 2:
+            sys.stderr.write("Missing argument: <file>\n")
+            sys.exit(1)
+        if len(args) > 3:
             sys.stderr.write("Too many arguments\n")
             sys.exit(1)
 
-        info()
+        path = args[1]
+        seconds = None
+        if len(args) == 3:
+            seconds = float(args[2])
+            if seconds <= 0:
+                sys.stderr.write("<seconds> must be greater than 0\n")
+                sys.exit(1)
+        return lambda dev: record_ex(dev, path, seconds)
+
+    elif cmd == "copy":
+        keep_name = "--keep-name" in args
+        verify = "--verify" in args
+        args = [a for a in args if a != "--keep-name" and a != "--verify"]
+        if len(args) != 3:
+            sys.stderr.write("USAGE: copy [--keep-name] [--verify] [<num>:]<profile> "
+                             "[<num>:]<profile>\n")
+            sys.exit(1)
+
+        src, src_profile = check_location(args[1])
+        dst, dst_profile = check_location(args[2])
+        if (src, src_profile) == (dst, dst_profile):
+            sys.stderr.write("Source and destination are the same\n")
+            sys.exit(1)
+
+        def run(dev):
+            devs = {devnum: dev}
+            opened = []
+            try:
+                for num in (src, dst):
+                    if num not in devs:
+                        devs[num] = get_controller(num)
+                        opened.append(devs[num])
+                written = copy_ex(devs[src], src_profile, devs[dst], dst_profile, keep_name,
+                                  verify)
+            finally:
+                for other in opened:
+                    release_controller(other)
+            print(f"Copied profile {src_profile} of device {src} to profile {dst_profile} "
+                  f"of device {dst} ({written} bytes written)")
+
+        return run
+
+    elif cmd == "scan":
+        write = "--write" in args
+        args = [a for a in args if a != "--write"]
+        if len(args) > 2:
+            sys.stderr.write("Too many arguments\n")
+            sys.exit(1)
+
+        first, last = 0, 255
+        if len(args) == 2:
+            a, _, b = args[1].partition("-")
+            try:
+                first = int(a, 0)
+                last = int(b, 0) if b != "" else first
+            except ValueError:
+                sys.stderr.write(f"Incorrect profile range: {args[1]}\n")
+                sys.exit(1)
+            if first < 0 or last > 255 or first > last:
+                sys.stderr.write("Profile range must be within 0-255\n")
+                sys.exit(1)
+        return lambda dev: scan_ex(dev, first, last, write)
+
+    elif cmd == "apply":
+        dry_run = "--dry-run" in args
+        args = [a for a in args if a != "--dry-run"]
+        if len(args) != 2:
+            sys.stderr.write("USAGE: apply [--dry-run] <file>\n")
+            sys.exit(1)
+
+        desired = read_settings_file(args[1])
+        return lambda dev: apply_ex(dev, desired, dry_run)
+
+    elif cmd == "backup" or cmd == "restore":
+        if len(args) < 2:
+            sys.stderr.write("Missing argument: <file>\n")
+            sys.exit(1)
+        if len(args) > 2:
+            sys.stderr.write("Too many arguments\n")
+            sys.exit(1)
+
+        path = args[1]
+        if cmd == "backup":
+            return lambda dev: backup_ex(dev, path)
+        snapshot = read_backup(path)
+        return lambda dev: restore_ex(dev, snapshot)
 
     else:
         sys.stderr.write(f"Invalid command: {cmd}\n")
         sys.exit(1)
+
+
+# Reads commands, one per line, from the file <path> ("-" for stdin, or <text> if it is not
+# None) and returns a list of (line, function) for run_batch_ex(). Empty lines and lines
+# starting with # are skipped.
+def parse_batch(path, text=None):
+    import shlex
+
+    if text is not None:
+        lines = text.splitlines()
+    elif path == "-":
+        lines = sys.stdin.readlines()
+    else:
+        try:
+            with open(path) as f:
+                lines = f.readlines()
+        except OSError as err:
+            sys.stderr.write(f"{err}\n")
+            sys.exit(1)
+
+    actions = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        try:
+            args = shlex.split(line)
+            if args[0] in ("devices", "batch"):
+                sys.stderr.write(f"Command not allowed in batch: {args[0]}\n")
+                sys.exit(1)
+            actions.append((line, parse_command(args)))
+        except (SystemExit, ValueError) as err:
+            if isinstance(err, ValueError):
+                sys.stderr.write(f"{err}\n")
+            sys.stderr.write(f"Error in line {lineno}: {line}\n")
+            sys.exit(1)
+    return actions
+
+
+# Executes the functions from a list of (line, function) on <dev> and writes the time taken
+# by each step to stderr.
+def run_batch_ex(dev, actions):
+    total = time.perf_counter()
+    for line, action in actions:
+        start = time.perf_counter()
+        action(dev)
+        sys.stderr.write(f"{(time.perf_counter() - start) * 1000:8.1f} ms  {line}\n")
+    sys.stderr.write(f"{(time.perf_counter() - total) * 1000:8.1f} ms  total\n")
+
+
+def default_socket():
+    rundir = os.environ.get("XDG_RUNTIME_DIR")
+    if rundir:
+        return os.path.join(rundir, f"hori-{devnum}.sock")
+    return os.path.join("/tmp", f"hori-{os.getuid()}-{devnum}.sock")
+
+
+# Serves requests for <dev> on the Unix socket <path> until interrupted.
+#
+# Clients send one JSON object per line. {"cmd": [<command>, <args>...]} executes a
+# command with the same syntax as on the command line and is answered with
+# {"ok": true, "output": <text printed by the command>} or {"ok": false, "error": <text>}.
+# {"cmd": ["refresh"]} discards the shadow copy of profile memory.
+# {"cmd": ["subscribe"]} is answered with {"ok": true, "output": ""} and then with
+# {"event": "profile", "profile": <profile>} for every change of the active profile.
+def serve_ex(dev, path):
+    import io
+    import json
+    import queue
+    import signal
+    import socketserver
+    from contextlib import redirect_stderr, redirect_stdout
+
+    lock = threading.Lock()
+    subscribers = []
+
+    def notify(d, profile):
+        if d is dev:
+            for q in list(subscribers):
+                q.put(profile)
+
+    def execute(args):
+        out = io.StringIO()
+        err = io.StringIO()
+        with lock, redirect_stdout(out), redirect_stderr(err):
+            try:
+                if args == ["refresh"]:
+                    shadow.pop(dev, None)
+                    profile_images(dev, (1, 2, 3, 4))
+                elif args[0] in ("devices", "batch", "daemon", "subscribe", "watch"):
+                    sys.stderr.write(f"Command not allowed: {args[0]}\n")
+                    sys.exit(1)
+                elif (args[0] == "monitor" and len([a for a in args if a != "-v"]) < 2
+                      or args[0] == "record" and len(args) < 3):
+                    # Would keep the device (and all other clients) busy until the daemon ends
+                    sys.stderr.write(f"{args[0]} needs <seconds> when sent to the daemon\n")
+                    sys.exit(1)
+                else:
+                    parse_command(args)(dev)
+            except SystemExit:
+                return {"ok": False, "error": err.getvalue() + out.getvalue()}
+            except Exception as e:  # HoriError, but also e.g. ValueError for "map x"
+                return {"ok": False, "error": f"{err.getvalue()}{e}\n"}
+        return {"ok": True, "output": out.getvalue()}
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def send(self, obj):
+            self.wfile.write((json.dumps(obj) + "\n").encode())
+            self.wfile.flush()
+
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    args = [str(a) for a in json.loads(line)["cmd"]]
+                    if len(args) == 0:
+                        raise ValueError()
+                except (ValueError, KeyError, TypeError):
+                    self.send({"ok": False, "error": "Invalid request\n"})
+                    continue
+
+                if args == ["subscribe"]:
+                    self.subscribe()
+                    return
+                self.send(execute(args))
+
+        def subscribe(self):
+            q = queue.Queue()
+            subscribers.append(q)
+            # Keep reading from the controller between commands to receive the reports
+            get_reader(dev).hold(reports=False)
+            try:
+                self.send({"ok": True, "output": ""})
+                while True:
+                    self.send({"event": "profile", "profile": q.get()})
+            except OSError:
+                pass
+            finally:
+                subscribers.remove(q)
+                get_reader(dev).unhold(reports=False)
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = Server(path, Handler)
+    os.chmod(path, 0o600)
+    profile_listeners.append(notify)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Commands that only print information are answered from the shadow copies
+    profile_images(dev, (1, 2, 3, 4))
+    print(f"Listening on {path}")
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        profile_listeners.remove(notify)
+
+
+# Sends the command <args> to the daemon listening on <path> and prints its answer.
+def client_request(path, args):
+    import json
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as err:
+        sys.stderr.write(f"Could not connect to daemon at {path}: {err}\n")
+        sys.exit(1)
+
+    f = sock.makefile("rwb")
+    f.write((json.dumps({"cmd": args}) + "\n").encode())
+    f.flush()
+    for line in f:
+        reply = json.loads(line)
+        if "event" in reply:
+            print(f"Current profile is {reply['profile']}")
+            sys.stdout.flush()
+        elif not reply["ok"]:
+            sys.stderr.write(reply["error"])
+            sys.exit(1)
+        else:
+            sys.stdout.write(reply["output"])
+            if args != ["subscribe"]:
+                break
+    else:
+        # The daemon closed the connection without answering (or ended the subscription)
+        sys.stderr.write(f"Connection to daemon at {path} closed\n")
+        sys.exit(1)
+    sock.close()
+
+
+# Returns the device numbers selected by <selection>, which is "all" or a comma separated
+# list of device numbers.
+def select_devices(selection: str):
+    count = len(get_devices())
+    if selection == "all":
+        if count == 0:
+            sys.stderr.write("No supported devices found\n")
+            sys.exit(1)
+        return list(range(count))
+
+    numbers = []
+    for num in selection.split(","):
+        try:
+            n = int(num, 10)
+        except ValueError:
+            sys.stderr.write(f"Not a number: {num}\n")
+            sys.exit(1)
+        if n < 0 or n >= count:
+            sys.stderr.write(f"Incorrect device number: {n}\n")
+            sys.exit(1)
+        if n not in numbers:
+            numbers.append(n)
+    return numbers
+
+
+# Runs this program with <args> for each of the devices <numbers> in parallel, one process
+# per device, and prints the output of each process. Returns the list of device numbers
+# for which the program failed.
+def run_on_devices(numbers, args, stdin_data=None):
+    import subprocess
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(num):
+        return subprocess.run([sys.executable, __file__, "-d", str(num)] + args,
+                              input=stdin_data,
+                              stdin=None if stdin_data is not None else subprocess.DEVNULL,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+
+    with ThreadPoolExecutor(max_workers=len(numbers)) as pool:
+        results = list(pool.map(run, numbers))
+
+    device_list = get_devices()
+    failed = []
+    for num, result in zip(numbers, results):
+        _, _, bus, addr = device_list[num]
+        print(f"=== Device {num} (bus {bus}, address {addr}) ===")
+        sys.stdout.write(result.stdout.decode(errors="replace"))
+        sys.stdout.flush()
+        sys.stderr.write(result.stderr.decode(errors="replace"))
+        sys.stderr.flush()
+        if result.returncode != 0:
+            failed.append(num)
+
+    print("==============================================")
+    if len(failed) > 0:
+        print(f"Failed on {len(failed)} of {len(numbers)} devices: "
+              f"{', '.join(str(n) for n in failed)}")
+    else:
+        print(f"Succeeded on all {len(numbers)} devices")
+    return failed
+
+
+def main():
+    global devnum, cache_dir, verify_cache, refresh_cache, socket_path, reply_timeout, retries
+    global tracer
+
+    selection = None  # argument of -d if it selects multiple devices
+    trace_path = None
+    stats = False
+    forwarded = []  # options passed on to the processes for the selected devices
+    while len(sys.argv) > 2 and sys.argv[1].startswith("-"):
+        opt = sys.argv.pop(1)
+        if opt != "-d":
+            forwarded.append(opt)
+        if opt == "-d":
+            if sys.argv[1] == "all" or "," in sys.argv[1]:
+                selection = sys.argv.pop(1)
+                continue
+            try:
+                devnum = int(sys.argv[1], 10)
+            except:
+                sys.stderr.write(f"Not a number: {sys.argv[1]}\n")
+                sys.exit(1)
+            sys.argv.pop(1)
+        elif opt == "--cache":
+            cache_dir = os.path.join(
+                os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "hori")
+        elif opt == "--verify":
+            verify_cache = True
+        elif opt == "--refresh":
+            refresh_cache = True
+        elif opt == "--socket":
+            socket_path = sys.argv.pop(1)
+            forwarded.append(socket_path)
+        elif opt == "--trace":
+            trace_path = sys.argv.pop(1)
+            forwarded.append(trace_path)
+        elif opt == "--stats":
+            stats = True
+        elif opt == "--timeout" or opt == "--retries":
+            forwarded.append(sys.argv[1])
+            try:
+                n = int(sys.argv.pop(1), 10)
+            except ValueError:
+                sys.stderr.write(f"Not a number: {forwarded[-1]}\n")
+                sys.exit(1)
+            if n < (1 if opt == "--timeout" else 0):
+                sys.stderr.write(f"Invalid value for {opt}: {n}\n")
+                sys.exit(1)
+            if opt == "--timeout":
+                reply_timeout = n / 1000
+            else:
+                retries = n
+        else:
+            sys.stderr.write(f"Invalid option: {opt}\n")
+            sys.exit(1)
+
+    if len(sys.argv) < 2:
+        sys.stderr.write('''Usage: hori.py [<options>] <command> [<args>...]
+
+-d <num>
+  Select the device to operate on, if multiple supported devices are
+  connected to the computer.
+
+-d all
+-d <num>,<num>,...
+  Execute the command on all devices or on the listed devices at the same
+  time. The output is printed per device, followed by a list of the devices
+  for which the command failed.
+
+--cache
+  Keep a copy of the profile memory of the device in ~/.cache/hori (or
+  $XDG_CACHE_HOME/hori) and use it instead of reading profile memory from
+  the device. Only use this if the device is not configured by other means
+  (e.g. the Hori Device Manager) between calls of this program.
+
+--verify
+  With --cache, check the cached copy against the device's memory.
+
+--refresh
+  With --cache, ignore the cached copy and read the device's memory.
+
+--timeout <ms>
+  Time to wait for a reply from the device before a request is sent again
+  (default: 100).
+
+--retries <n>
+  Number of times a request is sent again before giving up (default: 2).
+
+--trace <file>
+  Write all packets sent to and received from the device to <file>, as pcap
+  file (that can be opened with Wireshark) if <file> ends in .pcap, otherwise
+  as JSON lines. With -d all or a list of devices, {} in <file> is replaced by
+  the device number. With inventory, the packets of all devices are written to
+  the same <file>.
+
+--stats
+  Print the number of requests, retries and timeouts and the round trip times
+  for each type of request to stderr when the command is finished.
+
+--socket <path>
+  Send the command to the daemon listening on the Unix socket <path> instead
+  of accessing the device directly. With the daemon command, listen on <path>.
+
+devices
+  Lists all devices supported by this program, together with the <num>
+  for use with -d.
+
+inventory [--json | --csv] [--reference <file>]
+  Query all supported devices at the same time and list for each of them the
+  firmware version, the active profile and a SHA-256 hash of the memory of
+  each profile, as table, JSON or CSV. With --reference, compare each device
+  with a <file> written by backup and list the differences (drift). Exits
+  with status 1 if a device could not be queried or differs from <file>.
+
+hexdump <profile> [-b] [<ofs> [<size>]]
+  Dump <size> bytes starting at <ofs> of config memory for <profile>
+  With -b, write the raw bytes instead of hex numbers (e.g. to a .bin file
+  for isolate.py).
+
+write <profile> <ofs> <data>
+  Write <data> bytes to config memory of <profile> starting at <ofs>
+
+profile [<profile>]
+  With no argument, print out currently active profile.
+  With argument, make <profile> active.
+
+name [<profile> [<name>]]
+  With no arguments, lists the names of all profiles.
+  With only <profile> as argument, lists that profile's name.
+  With <profile> and <name>, renames <profile>.
+
+reset <profile>
+  Reset all values of <profile>, except for the name, to default values.
+
+map <profile> [--json] [default] [<button>=<function> ...]
+  If only <profile> is specified, print the current button mappings
+  (as JSON with --json).
+  If <button>=<function> ... arguments are specified, the respective button
+  mappings are modified. Buttons not listed are left unchanged.
+  If "default" is specified as argument, all button mappings for <profile>
+  are reset to their default values.
+
+stick <profile> [ LS | RS ]
+  If only <profile> is specified, print whether the analog stick of <profile>
+  is configured as LS or RS.
+  If "LS" or "RS" is specified, configure analog stick of <profile> to that.
+
+dpad <profile> [ default | <up>,<down>,<left>,<right>,<upleft>,<upright>,<downleft>,<downright> ]
+  If only <profile> is specified, print out the D-Pad dead zone of <profile>.
+  If "default" is specified, reset the D-Pad dead zone of <profile> to the default.
+  <up>,<down>,<left>,<right> is the dead zone of the cardinals (0 to 228, where 228
+  is the maximum, i.e. you have to press really hard to activate the direction).
+  <upleft>,<upright>,<downleft>,<downright> is the dead zone of the diagonals
+  (30 to 255, where 255 is the maximum).
+  The default is balanced mode with the dead zones the HDM uses for it. Setting
+  the dead zones switches balanced mode off.
+
+info [--json]
+  Print out all information that can be extracted from the controller.
+  With --json, print the decoded settings of all profiles (name, audio,
+  D-Pad dead zones, button mappings and stick) as a JSON array.
+
+monitor [-v] [<seconds>]
+  Print the button presses and releases reported by the controller, together
+  with the time each button was held, for <seconds> seconds or until
+  interrupted with Ctrl+C. Once per second the number of reports received,
+  the intervals between them and the number of lost reports are printed.
+  At the end, a histogram of the intervals and the press statistics of each
+  button are printed. With -v, every report is printed.
+
+watch [<hook>]
+  Wait for changes of the active profile with the profile button of the
+  controller until interrupted with Ctrl+C, and print the number and name of
+  the new profile. If <hook> is given, run it instead for every change.
+  <hook> is either <module>:<function>, a Python function that is called with
+  the profile number and its settings, or a shell command, which is run with
+  the environment variables HORI_PROFILE (the profile number), HORI_NAME (its
+  name) and HORI_SETTINGS (its settings as JSON, see info --json).
+
+record <file> [<seconds>]
+  Append the input reports of the controller to <file> for <seconds> seconds
+  or until interrupted with Ctrl+C. Each report is stored as a record of
+  fixed size with the time it was received. Use analyze.py to evaluate the
+  recording.
+
+copy [--keep-name] [--verify] [<num>:]<profile> [<num>:]<profile>
+  Copy the memory of the first <profile> to the second <profile>, of the
+  device <num> if given (default: the device selected with -d). The memory is
+  written while it is being read. With --keep-name, the name of the second
+  profile is not changed. With --verify, the copy is read back and checked.
+
+scan [--write] [<first>[-<last>]]
+  Find out which profile numbers from <first> to <last> (default: 0-255) the
+  controller answers memory requests for, how much memory each of them has
+  and how many bytes can be read with one request, and print a map of the
+  readable regions. With --write, also probe which regions can be written by
+  writing back the bytes that have been read. Requests that are not answered
+  are sent again as set with --timeout and --retries, so e.g. "--retries 0
+  --timeout 30" speeds up the scan.
+
+backup <file>
+  Save the memory of all profiles, the number of the active profile and the
+  firmware version to <file>.
+
+restore <file>
+  Restore all profiles and the active profile from a <file> written by backup.
+  Only the bytes that differ from the controller's memory are written, so
+  restoring a backup to a controller that already matches it is fast. This
+  can be combined with "-d all" to configure many controllers at once.
+
+apply [--dry-run] <file>
+  Change the controller to the settings in the JSON or TOML (if <file> ends in
+  .toml) <file>: a list of profiles in the format printed by "info --json", or
+  an object with the list as "profiles" and optionally the profile to activate
+  as "active". Settings not listed are left unchanged, e.g.
+    [{"profile": 1, "name": "X", "stick": "RS",
+      "buttons": {"A": "B", "LB": "DISABLED"}, "dpad": {"up": 76}}]
+  Only the bytes that differ are written, so applying a <file> the controller
+  already matches writes nothing. With --dry-run, only print the changes.
+
+batch [<file>]
+  Execute the commands from <file> (or stdin if <file> is missing or "-"),
+  one command per line, with the same syntax as on the command line, e.g.
+  "map 1 A=B". Empty lines and lines starting with # are ignored. All
+  commands are checked before the first one is executed. The time taken by
+  each command is printed to stderr.
+
+daemon
+  Keep the device open and execute commands sent by "hori.py --socket <path>"
+  until interrupted. The daemon listens on the Unix socket given with --socket
+  (default: $XDG_RUNTIME_DIR/hori-<num>.sock). Profile memory is only read
+  once, so commands that only print information are answered immediately.
+  monitor and record are only accepted with <seconds>.
+
+subscribe
+  Only with --socket. Print the number of the active profile whenever it is
+  changed with the profile button on the controller.
+
+<profile> 1..4
+<ofs> 0..
+<size> 1..
+<data> Sequence of numbers in range 0..255
+<name> String with maximum of 16 characters
+<button> is the name of a button as printed on the controller. The names of
+         the special buttons are SELECT/VIEW, GUIDE/XBOX, SHARE, START/MENU.
+         Button names are case-insensitive.
+<function> specifies what the <button> is supposed to transmit to the PC/console
+         when pressed. Available functions are:
+         A, B, X, Y, LB, RB, LT, RT, LSB, RSB,
+         SELECT, VIEW, GUIDE, XBOX, SHARE, START, MENU,
+         DPAD-UP, DPAD-DOWN, DPAD-LEFT, DPAD-RIGHT,
+         LS-UP, LS-DOWN, LS-LEFT, LS-RIGHT,
+         RS-UP, RS-DOWN, RS-LEFT, RS-RIGHT,
+         DISABLED
+
+''')
+        sys.exit(1)
+
+    cmd = sys.argv[1]
+    if socket_path is not None and cmd != "daemon":
+        client_request(socket_path, sys.argv[1:])
+        sys.exit(0)
+
+    if cmd == "devices":
+        devices()
+        sys.exit(0)
+
+    if cmd == "inventory":
+        fmt = "text"
+        reference = None
+        args = sys.argv[2:]
+        while len(args) > 0:
+            arg = args.pop(0)
+            if arg == "--json" or arg == "--csv":
+                fmt = arg[2:]
+            elif arg == "--reference" and len(args) > 0:
+                reference = read_backup(args.pop(0))
+            else:
+                sys.stderr.write(f"Invalid argument: {arg}\n")
+                sys.exit(1)
+        # The devices are queried from several threads, which share the tracer
+        if trace_path is not None or stats:
+            tracer = Tracer(trace_path)
+        try:
+            failed = inventory(fmt, reference)
+        finally:
+            if tracer is not None:
+                tracer.close()
+                if stats:
+                    tracer.print_stats()
+        sys.exit(1 if failed > 0 else 0)
+
+    if selection is not None:
+        if cmd == "daemon":
+            sys.stderr.write("daemon can only be used with a single device\n")
+            sys.exit(1)
+        numbers = select_devices(selection)
+        stdin_data = None
+        if cmd == "batch":
+            if len(sys.argv) > 3:
+                sys.stderr.write("Too many arguments\n")
+                sys.exit(1)
+            # Check all commands before any of them is executed on any device
+            if len(sys.argv) == 2 or sys.argv[2] == "-":
+                stdin_data = sys.stdin.buffer.read()
+                parse_batch("-", stdin_data.decode())
+            else:
+                parse_batch(sys.argv[2])
+        else:
+            parse_command(sys.argv[1:])
+        failed = run_on_devices(numbers, forwarded + sys.argv[1:], stdin_data)
+        sys.exit(1 if len(failed) > 0 else 0)
+
+    if cmd == "daemon":
+        if len(sys.argv) > 2:
+            sys.stderr.write("Too many arguments\n")
+            sys.exit(1)
+        path = socket_path or default_socket()
+        run = lambda dev: serve_ex(dev, path)
+    elif cmd == "batch":
+        if len(sys.argv) > 3:
+            sys.stderr.write("Too many arguments\n")
+            sys.exit(1)
+        actions = parse_batch(sys.argv[2] if len(sys.argv) == 3 else "-")
+        run = lambda dev: run_batch_ex(dev, actions)
+    else:
+        run = parse_command(sys.argv[1:])
+
+    check_device()
+    if trace_path is not None or stats:
+        tracer = Tracer(None if trace_path is None else trace_path.replace("{}", str(devnum)))
+    dev = get_controller()
+    try:
+        run(dev)
+    finally:
+        release_controller(dev)
+        if tracer is not None:
+            tracer.close()
+            if stats:
+                tracer.print_stats()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except HoriError as err:
+        sys.stderr.write(f"{err}\n")
+        sys.exit(1)
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+'''
+Asynchronous interface to the controllers supported by hori.py for asyncio programs.
+
+    import asyncio
+    import hori_async
+
+    async def main():
+        async with hori_async.HoriController(0) as pad:
+            print(await pad.get_profile())
+            print(await pad.mappings(1))
+            async for event in pad.events():
+                print(event)
+
+    asyncio.run(main())
+
+The USB I/O of each HoriController runs in a worker thread of its own, so the event loop
+is never blocked and operations on several controllers can be awaited concurrently (e.g.
+with asyncio.gather()). Operations on the same controller are executed one at a time in
+the order they were started.
+
+Errors are reported as exceptions instead of terminating the program: hori.HoriError for
+errors of the controller or the USB connection, ValueError for invalid arguments.
+'''
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+
+import hori
+
+# Events yielded by HoriController.events():
+#   kind: "profile" (the active profile has been changed with the profile button of the
+#         controller), "pressed" or "released"
+#   time: time.monotonic() of the arrival of the report
+#   value: the new profile for "profile", the name of the button (see hori.INPUT_BUTTONS)
+#          for "pressed" and "released"
+Event = collections.namedtuple("Event", "kind time value")
+
+
+def check_range(profile: int, ofs: int, size: int):
+    if profile < 1 or profile > 4:
+        raise ValueError(f"<profile> must be between 1 and 4: {profile}")
+    if ofs < 0 or size < 0 or ofs + size > hori.PROFILE_MEM_SIZE:
+        raise ValueError(f"Memory range {ofs}+{size} is outside of profile memory "
+                         f"(0-{hori.PROFILE_MEM_SIZE - 1})")
+
+
+class HoriController:
+    '''
+    A controller, identified by its device number as listed by "hori.py devices". The
+    controller is claimed by open() (or "async with") and released by close().
+    '''
+
+    def __init__(self, devnum: int = 0):
+        self.devnum = devnum
+        self.dev = None
+        self.executor = None
+        self.lock = threading.Lock()
+        self.subscribers = []  # (event loop, asyncio.Queue) of each events() iterator
+        self.pump = None  # thread that delivers reports to the subscribers
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _open(self):
+        try:
+            count = len(hori.get_devices())
+        except (OSError, ImportError) as err:
+            raise hori.HoriError(f"Could not enumerate devices: {err}")
+        if self.devnum < 0 or self.devnum >= count:
+            raise hori.HoriError(f"Incorrect device number: {self.devnum}")
+        dev = hori.found_devices[self.devnum]
+        try:
+            dev.detach_kernel_driver(0)
+        except:
+            pass
+        return dev
+
+    async def open(self):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=f"hori-{self.devnum}")
+        if self.dev is None:
+            try:
+                self.dev = await self._run(self._open, opened=False)
+            except BaseException:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+                raise
+
+    async def close(self):
+        if self.executor is None:
+            return
+        with self.lock:
+            for loop, queue in self.subscribers:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+            self.subscribers.clear()
+        if self.dev is not None:
+            pump = self.pump
+            if pump is not None:
+                await asyncio.get_running_loop().run_in_executor(None, pump.join)
+            await self._run(hori.release_controller, self.dev)
+            hori.shadow.pop(self.dev, None)
+            self.dev = None
+        self.executor.shutdown(wait=False)
+        self.executor = None
+
+    # Runs <func>(*args) in the worker thread. USB errors are raised as hori.HoriError.
+    async def _run(self, func, *args, opened=True):
+        if opened and self.dev is None:
+            raise hori.HoriError("Controller is not open")
+
+        def call():
+            try:
+                return func(*args)
+            except OSError as err:  # includes usb.core.USBError
+                raise hori.HoriError(str(err)) from err
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    # Returns <size> bytes of the memory of <profile> starting at <ofs>, read from the
+    # controller.
+    async def read_mem(self, profile: int, ofs: int = 0,
+                       size: int = hori.PROFILE_MEM_SIZE) -> bytes:
+        check_range(profile, ofs, size)
+        return bytes(await self._run(hori.read_ex, self.dev, profile, ofs, size))
+
+    # Writes <data> to the memory of <profile> starting at <ofs>. With <changed_only>, only
+    # the bytes that differ from the (shadow copy of the) controller's memory are written.
+    async def write_mem(self, profile: int, ofs: int, data: bytes, changed_only: bool = False):
+        check_range(profile, ofs, len(data))
+        data = bytes(data)
+        await self._run(hori.update_ex if changed_only else hori.write_ex, self.dev, profile,
+                        ofs, data)
+
+    # Returns the active profile
+    async def get_profile(self) -> int:
+
+        def get():
+            return hori.transact(self.dev, (hori.CMD_GET_PROFILE, ), hori.REPLY_PROFILE, 2)[0]
+
+        return await self._run(get)
+
+    async def switch_profile(self, profile: int):
+        check_range(profile, 0, 0)
+
+        def switch():
+            hori.transact(self.dev, (hori.CMD_SWITCH_PROFILE, profile), hori.REPLY_DONE)
+
+        await self._run(switch)
+
+    # Returns the hori.Profile with the decoded settings of <profile>. Profile memory is only
+    # read from the controller the first time (or after refresh()).
+    async def settings(self, profile: int) -> hori.Profile:
+        check_range(profile, 0, 0)
+        return await self._run(hori.profile_settings, self.dev, profile)
+
+    # Returns a dict that maps each button to the function it transmits in <profile>
+    async def mappings(self, profile: int) -> dict:
+        return (await self.settings(profile)).buttons
+
+    # Discards the copies of profile memory kept by settings() and mappings(), e.g. after
+    # the profiles have been changed with another program.
+    async def refresh(self):
+        await self._run(hori.shadow.pop, self.dev, None)
+
+    # Yields an Event for every change of the active profile with the profile button and
+    # every button press and release until close() is called. Several iterators may be used
+    # at the same time, each receives all events that happen while it is active.
+    async def events(self):
+        if self.dev is None:
+            raise hori.HoriError("Controller is not open")
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        entry = (loop, queue)
+        with self.lock:
+            self.subscribers.append(entry)
+            if self.pump is None:
+                self.pump = threading.Thread(target=self._pump, daemon=True)
+                self.pump.start()
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+        finally:
+            with self.lock:
+                if entry in self.subscribers:
+                    self.subscribers.remove(entry)
+
+    def _deliver(self, event):
+        with self.lock:
+            for loop, queue in self.subscribers:
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    # Reads the reports of the controller while there are subscribers
+    def _pump(self):
+        reader = hori.get_reader(self.dev)
+        mon = hori.InputMonitor(size=1)
+        reader.hold()
+        try:
+            while True:
+                with self.lock:
+                    if len(self.subscribers) == 0:
+                        self.pump = None
+                        return
+                report = reader.next_report(time.monotonic() + 0.1)
+                if report is None:
+                    continue
+                t, packet = report
+                if packet[0] == hori.GIP_REPLY and packet[4] == hori.REPORT_PROFILE:
+                    self._deliver(Event("profile", t, packet[5]))
+                for button, _, hold in mon.add(t, packet):
+                    self._deliver(Event("pressed" if hold is None else "released", t, button))
+        except Exception as err:  # e.g. hori.HoriError, ends all events() iterators
+            with self.lock:
+                self.pump = None
+            self._deliver(err)
+        finally:
+            reader.unhold()
@@ -0,0 +1,301 @@
+#!/usr/bin/python
+'''
+Simulated Hori Fighting Commander Octa.
+
+SimulatedController implements the part of the PyUSB device interface used by
+hori.py (write() to endpoint 2, read() from endpoint 0x82) and answers the Hori
+GIP commands as described in hori_gip_reverse_eng.md. It is an independent model
+of the controller side of the protocol, so it does not import hori.py.
+
+Replies are delivered after a configurable latency. The controller processes
+requests one at a time, so replies to requests sent back to back are spaced at
+least <service_time> apart. Replies can be dropped at random and unsolicited
+0x0d profile change reports can be generated at random or with
+press_profile_button().
+
+With <input_rate> > 0, the controller sends 0x20 input reports at that rate
+(reports per second), and a random button changes state <press_rate> times per
+second. Reports that are not read in time are lost, as they would be if the host
+did not poll the controller, which shows up as a gap in their sequence numbers.
+
+hori.py talks to simulated controllers instead of USB devices if the environment
+variable HORI_SIM is set to a list of state files (separated by os.pathsep),
+one per simulated controller. Profile memory and active profile are loaded from
+the state file (factory state if it does not exist) and saved after every change.
+HORI_SIM_OPTS can be set to a comma separated list of <key>=<value> pairs for
+the keyword arguments of SimulatedController, e.g.
+    HORI_SIM_OPTS=latency=0.008,jitter=0.002,drop_rate=0.01
+'''
+import array
+import heapq
+import os
+import random
+import struct
+import threading
+import time
+
+try:
+    from usb.core import USBTimeoutError
+except ImportError:
+
+    class USBTimeoutError(TimeoutError):
+        pass
+
+
+PROFILE_MEM_SIZE = 421
+NUM_PROFILES = 4
+
+GIP_REQUEST = 0xf
+GIP_REPLY = 0x10
+
+CMD_WRITEMEM = 3
+CMD_READMEM = 4
+CMD_SWITCH_PROFILE = 7
+CMD_GET_VERSION = 9
+CMD_GET_PROFILE = 0xb
+
+REPLY_MEM = 5
+REPLY_DONE = 6
+REPLY_VERSION = 0xa
+REPLY_PROFILE = 0xc
+REPORT_PROFILE = 0xd
+GIP_INPUT = 0x20
+
+# Buttons in the button word of an input report: START, SELECT, A, B, X, Y, D-Pad, LB, RB, LSB, RSB
+INPUT_BUTTON_BITS = list(range(2, 16))
+
+# The controller pads all its replies to 64 bytes
+REPLY_SIZE = 64
+
+
+def factory_profile() -> bytearray:
+    # State of a profile that has never been touched by the HDM (see "Summary Profile 3")
+    mem = bytearray(PROFILE_MEM_SIZE)
+    mem[0x28:0x2d] = bytes([0x01, 0x32, 0x32, 0x00, 0x02])
+    mem[0x31:0x36] = bytes([0x1e, 0x1e, 0x1e, 0x1e, 0x01])
+    return mem
+
+
+class SimulatedController:
+    idVendor = 0x0f0d
+    idProduct = 0x0150
+    manufacturer = "HORI CO.,LTD."
+    product = "FIGHTING COMMANDER OCTA (simulated)"
+
+    def __init__(self,
+                 latency: float = 0.004,
+                 service_time: float = 0.001,
+                 write_latency: float = 0.016,
+                 jitter: float = 0.0,
+                 drop_rate: float = 0.0,
+                 profile_change_rate: float = 0.0,
+                 input_rate: float = 0.0,
+                 press_rate: float = 0.0,
+                 firmware: str = "0109",
+                 seed: int = None,
+                 bus: int = 0,
+                 address: int = 1,
+                 state_file: str = None):
+        self.latency = latency
+        self.service_time = service_time
+        self.write_latency = write_latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.profile_change_rate = profile_change_rate
+        self.input_rate = input_rate
+        self.press_rate = press_rate
+        self.firmware = firmware
+        self.bus = bus
+        self.address = address
+        self.serial_number = f"SIM{bus:03d}{address:03d}"
+        self.state_file = state_file
+
+        self.memory = [factory_profile() for _ in range(NUM_PROFILES)]
+        self.active_profile = 1
+        if state_file is not None and os.path.exists(state_file):
+            self.load(state_file)
+
+        self.random = random.Random(seed)
+        self.lock = threading.Condition(threading.RLock())
+        self.replies = []  # heap of (due time, tie breaker, packet)
+        self.busy_until = 0.0
+        self.report_seq = 0
+        self.counter = 0
+        self.next_profile_change = self.schedule_profile_change(time.monotonic())
+        self.input_seq = 0
+        self.buttons = 0
+        self.next_input = time.monotonic() if input_rate > 0 else float("inf")
+
+        # Statistics
+        self.requests = 0
+        self.dropped = 0
+
+    def load(self, path: str):
+        with open(path, "rb") as f:
+            data = f.read()
+        self.active_profile = data[0]
+        for p in range(NUM_PROFILES):
+            start = 1 + p * PROFILE_MEM_SIZE
+            self.memory[p][:] = data[start:start + PROFILE_MEM_SIZE]
+
+    def save(self, path: str):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(bytes([self.active_profile]))
+            for mem in self.memory:
+                f.write(mem)
+        os.replace(tmp, path)
+
+    def schedule_profile_change(self, now: float) -> float:
+        if self.profile_change_rate <= 0:
+            return float("inf")
+        return now + self.random.expovariate(self.profile_change_rate)
+
+    def detach_kernel_driver(self, interface: int):
+        pass
+
+    def attach_kernel_driver(self, interface: int):
+        pass
+
+    def queue_reply(self, due: float, packet: bytes):
+        packet = packet + bytes(REPLY_SIZE - len(packet))
+        self.counter += 1
+        heapq.heappush(self.replies, (due, self.counter, packet))
+        self.lock.notify_all()
+
+    def press_profile_button(self, profile: int = None):
+        with self.lock:
+            if profile is None:
+                profile = self.active_profile % NUM_PROFILES + 1
+            self.active_profile = profile
+            self.report_seq = (self.report_seq + 1) & 255
+            self.queue_reply(time.monotonic(),
+                             bytes([GIP_REPLY, 0, self.report_seq, 0x3c, REPORT_PROFILE, profile]))
+            self.persist()
+
+    def input_report(self, now: float) -> bytes:
+        period = 1 / self.input_rate
+        missed = int((now - self.next_input) / period)
+        self.next_input += (missed + 1) * period
+        self.input_seq = (self.input_seq + missed) % 255 + 1
+        if self.random.random() < self.press_rate * period * (missed + 1):
+            self.buttons ^= 1 << self.random.choice(INPUT_BUTTON_BITS)
+        return bytes([GIP_INPUT, 0, self.input_seq, 0x0e]) + struct.pack(
+            "<HHHhhhh", self.buttons, 0, 0, 0, 0, 0, 0)
+
+    def persist(self):
+        if self.state_file is not None:
+            self.save(self.state_file)
+
+    def execute(self, cmd: int, data: bytes):
+        # Returns (payload of the reply, True if the command takes write_latency) or
+        # (None, False) if the controller does not reply to the command.
+        if cmd == CMD_READMEM or cmd == CMD_WRITEMEM:
+            if len(data) < 4:
+                return None, False
+            profile, ofs, count = data[0], (data[1] << 8) + data[2], data[3]
+            if profile < 1 or profile > NUM_PROFILES:
+                return None, False
+            if count > 55 or ofs + count > PROFILE_MEM_SIZE:
+                return None, False
+            mem = self.memory[profile - 1]
+            if cmd == CMD_READMEM:
+                return bytes([REPLY_MEM]) + bytes(data[0:4]) + mem[ofs:ofs + count], False
+            mem[ofs:ofs + count] = bytes(data[4:4 + count]).ljust(count, b"\0")
+            self.persist()
+            return bytes([REPLY_DONE]), True
+
+        if cmd == CMD_SWITCH_PROFILE:
+            if len(data) < 1 or data[0] < 1 or data[0] > NUM_PROFILES:
+                return None, False
+            self.active_profile = data[0]
+            self.persist()
+            return bytes([REPLY_DONE]), True
+
+        if cmd == CMD_GET_PROFILE:
+            return bytes([REPLY_PROFILE, self.active_profile, 1]), False
+
+        if cmd == CMD_GET_VERSION:
+            return bytes([REPLY_VERSION]) + self.firmware.encode("utf-16-le"), False
+
+        return None, False
+
+    def write(self, endpoint: int, data, timeout: int = None) -> int:
+        data = bytes(data)
+        if endpoint != 2 or len(data) < 5 or data[0] != GIP_REQUEST:
+            return len(data)
+
+        with self.lock:
+            self.requests += 1
+            payload, slow = self.execute(data[4], data[5:4 + data[3]])
+            if payload is None:
+                return len(data)
+            if self.random.random() < self.drop_rate:
+                self.dropped += 1
+                return len(data)
+
+            now = time.monotonic()
+            due = now + (self.write_latency if slow else self.latency)
+            due = max(due, self.busy_until + self.service_time)
+            self.busy_until = due
+            if self.jitter > 0:
+                due += self.random.uniform(0, self.jitter)
+            self.queue_reply(due, bytes([GIP_REPLY, 0, data[2], 0x3c]) + payload)
+        return len(data)
+
+    def read(self, endpoint: int, size: int, timeout: int = None) -> array.array:
+        deadline = time.monotonic() + (timeout if timeout else 1000) / 1000
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                if now >= self.next_profile_change:
+                    self.next_profile_change = self.schedule_profile_change(now)
+                    self.press_profile_button()
+
+                if len(self.replies) > 0 and self.replies[0][0] <= now:
+                    return array.array("B", heapq.heappop(self.replies)[2][:size])
+                if now >= self.next_input:
+                    return array.array("B", self.input_report(now)[:size])
+
+                wakeup = min(deadline, self.next_profile_change, self.next_input)
+                if len(self.replies) > 0:
+                    wakeup = min(wakeup, self.replies[0][0])
+                if now >= deadline:
+                    raise USBTimeoutError("Operation timed out")
+                self.lock.wait(wakeup - now)
+
+
+# Keyword arguments for SimulatedController from HORI_SIM_OPTS
+def options_from_env() -> dict:
+    opts = {}
+    for item in os.environ.get("HORI_SIM_OPTS", "").split(","):
+        if item.strip() == "":
+            continue
+        key, _, value = item.partition("=")
+        key = key.strip()
+        if key in ("seed", ):
+            opts[key] = int(value, 0)
+        elif key == "firmware":
+            opts[key] = value
+        else:
+            opts[key] = float(value)
+    return opts
+
+
+simulated = None
+
+
+# Stand-in for usb.core.find() that searches the controllers listed in HORI_SIM
+def find(find_all: bool = False, **match):
+    global simulated
+    if simulated is None:
+        opts = options_from_env()
+        simulated = []
+        for idx, path in enumerate(os.environ.get("HORI_SIM", "").split(os.pathsep)):
+            if path != "":
+                simulated.append(SimulatedController(address=idx + 1, state_file=path, **opts))
+
+    found = [d for d in simulated if all(getattr(d, k) == v for k, v in match.items())]
+    if find_all:
+        return found
+    return found[0] if len(found) > 0 else None
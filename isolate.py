@@ -1,45 +1,154 @@
 #!/bin/python
 '''
 USAGE: isolate <f> ... =  <f> ... != <f> ... = <f>... != <f> ...
+       isolate --live [-d <num>] <profile>
 
 Each <f> is a file containing a memory dump as produced by hori.py hexdump.
+Files whose name ends in .bin contain the raw bytes of the dump (as produced by
+hori.py hexdump -b) and are memory-mapped instead of parsed.
 Files are processed in sequence. Each file is compared with the previous file.
 If the most recent operator on the command line was "=" (the default as long
 as no other operator overrides it), then all offsets are eliminated from
 consideration where the files differ. If the most recent operator was "!=", then
 all offsets are eliminated from consideration where the files are equal.
 After the last file, the program lists all remaining offsets with the values
-they had in all the files.
+they had in all the files. Offsets beyond the end of the shortest file are
+eliminated.
+
+Only the values at the offsets that have not been eliminated yet are kept in
+memory, so thousands of files can be processed. Requires NumPy.
+
+With --live, the memory of <profile> is read directly from the controller
+(device <num> as listed by "hori.py devices"). After each change of a setting on
+the controller (or with another program) enter "=" or "!=" to take a new
+snapshot and compare it with the previous one as described above. The
+remaining offsets are printed after each snapshot, grouped into contiguous
+ranges together with their current values. Enter "r" to start over with a new
+snapshot and "q" to quit. The controller is only claimed while a snapshot is
+taken.
 '''
 import sys
 
+import numpy as np
+
+
+# Returns the memory dump in the file <path> as array of uint8
+def load(path):
+    if path.endswith(".bin"):
+        return np.memmap(path, dtype=np.uint8, mode="r")
+    with open(path) as f:
+        text = f.read(-1)
+    try:
+        return np.frombuffer(bytes.fromhex(text), dtype=np.uint8)
+    except ValueError:  # not only 2 digit hex numbers
+        return np.array([int(x, 16) for x in text.split()], dtype=np.uint8)
+
 
+# Returns a mask of the values in <data2> that are not eliminated by comparing them with the
+# values at the same offsets in <data1>.
 def compare(op, data1, data2):
-    for i, d in enumerate(data1):
-        if d == -1 or (op == "=" and d != data2[i]) or (op == "!=" and d == data2[i]):
-            data2[i] = -1
+    if op == "=":
+        return data1 == data2
+    return data1 != data2
+
+
+# Eliminates offsets from <survivors> (None for the first dump) by comparing <data> with the
+# <previous> values at these offsets. Returns the remaining offsets and their values in <data>.
+def eliminate(op, survivors, previous, data):
+    if survivors is None:
+        survivors = np.arange(len(data))
+    else:
+        survivors = survivors[survivors < len(data)]
+        previous = previous[:len(survivors)]
+        survivors = survivors[compare(op, previous, data[survivors])]
+    return survivors, np.array(data[survivors])
+
+
+# Splits the sorted <offsets> into a list of arrays of consecutive offsets
+def ranges(offsets):
+    return np.split(offsets, np.flatnonzero(np.diff(offsets) != 1) + 1) if len(offsets) else []
+
+
+def snapshot(hori, profile):
+    dev = hori.get_controller()
+    try:
+        return np.frombuffer(hori.read_ex(dev, profile, 0, hori.PROFILE_MEM_SIZE), dtype=np.uint8)
+    finally:
+        hori.release_controller(dev)
+
+
+def live(hori, args):
+    try:
+        if len(args) > 1 and args[0] == "-d":
+            hori.devnum = int(args[1], 10)
+            args = args[2:]
+        if len(args) != 1:
+            raise ValueError()
+        profile = hori.check_profile(int(args[0], 0))
+    except ValueError:
+        sys.stderr.write(__doc__)
+        sys.exit(1)
+    hori.check_device()
+
+    survivors, values = eliminate("=", None, None, snapshot(hori, profile))
+    while True:
+        try:
+            cmd = input(f"{len(survivors)} offsets left. = / != / r / q: ").strip()
+        except EOFError:
+            break
+        if cmd == "q":
+            break
+        if cmd == "r":
+            survivors, values = eliminate("=", None, None, snapshot(hori, profile))
+            continue
+        if cmd == "==":
+            cmd = "="
+        if cmd != "=" and cmd != "!=":
+            continue
+
+        survivors, values = eliminate(cmd, survivors, values, snapshot(hori, profile))
+        for r in ranges(survivors):
+            vals = values[np.searchsorted(survivors, r)]
+            text = " ".join("{:02x}".format(v) for v in vals[:16])
+            if len(vals) > 16:
+                text += " ..."
+            if len(r) == 1:
+                print("{:04x}       {}".format(r[0], text))
+            else:
+                print("{:04x}-{:04x}  {}".format(r[0], r[-1], text))
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--live":
+        import hori
+        try:
+            live(hori, sys.argv[2:])
+        except hori.HoriError as err:
+            sys.stderr.write(f"{err}\n")
+            sys.exit(1)
+        sys.exit(0)
+
     op = "="
-    files = []
+    survivors = None  # offsets that have not been eliminated
+    columns = []  # for each file the values at the survivors
     for arg in sys.argv[1:]:
         if arg == "=" or arg == "==":
             op = "="
         elif arg == "!=":
             op = "!="
         else:
-            with open(arg) as f:
-                data = [int(x, 16) for x in f.read(-1).split()]
-                if len(files) > 0:
-                    compare(op, files[-1], data)
-                files.append(data)
-
-    if len(files) > 1:
-        data = files[-1]
-        for i, d in enumerate(data):
-            if d >= 0:
-                sys.stdout.write("{:04x} ".format(i))
-                for f in files:
-                    sys.stdout.write("{:02x} ".format(f[i]))
-                sys.stdout.write("\n")
+            data = load(arg)
+            previous = survivors
+            survivors, values = eliminate(op, survivors, columns[-1] if columns else None, data)
+            if previous is not None:
+                kept = np.searchsorted(previous, survivors)
+                columns = [column[kept] for column in columns]
+            columns.append(values)
+            del data
+
+    if len(columns) > 1:
+        table = np.stack(columns, axis=1)
+        for i, row in zip(survivors, table):
+            sys.stdout.write("{:04x} ".format(i))
+            sys.stdout.write("".join("{:02x} ".format(v) for v in row))
+            sys.stdout.write("\n")
@@ -0,0 +1,365 @@
+#!/usr/bin/python
+'''
+USAGE: replay.py [--sim] [-d <num>] [--device <bus>:<address>] [--speed <factor>]
+                 [--repeat <n>] [--write] [-v] <capture>
+
+Replays the GIP requests from a capture of the communication with a controller
+(e.g. of the Hori Device Manager) and compares the replies with the recorded
+ones. <capture> is one of
+  a pcap or pcapng file captured with Wireshark or tcpdump from a usbmon
+    interface (LINKTYPE_USB_LINUX or LINKTYPE_USB_LINUX_MMAPPED),
+  a text file from /sys/kernel/debug/usb/usbmon (usbmon text format),
+  a text file with "HOST>" and "<PAD" blocks of Wireshark hex dumps as in
+    hori_gip_reverse_eng.md.
+If the capture contains several devices, the one that received the most GIP
+requests is used, unless --device selects another one.
+
+The requests are sent to device <num> (see "hori.py devices"), or to an
+in-process simulated controller from hori_sim.py with --sim. They are sent with
+the pacing of the capture divided by <factor> (default: 1, i.e. the original
+pacing; 0 sends each request as soon as the previous one has been answered).
+--repeat sends the requests of the capture <n> times. Requests that change the
+controller's memory or active profile are skipped unless --write is given.
+
+Reports the distribution of the reply latencies for each type of request,
+compared with the latencies in the capture, and the requests whose replies
+differ from the recorded replies (with -v, all of them).
+'''
+import struct
+import sys
+import time
+
+import hori
+
+USBMON_HEADER = struct.Struct("<QBBBBHbbqiiII8s")
+LINKTYPE_USB_LINUX = 189
+LINKTYPE_USB_LINUX_MMAPPED = 220
+
+# Requests that modify the controller
+WRITE_COMMANDS = (hori.CMD_WRITEMEM, hori.CMD_SWITCH_PROFILE)
+
+
+# The readers return lists of (time in s, (bus, address), endpoint, data) for the packets
+# that were transferred.
+def usbmon_packet(t, header, data):
+    _, kind, _, ep, address, bus = USBMON_HEADER.unpack(header[:USBMON_HEADER.size])[:6]
+    # Data sent to the device is part of the URB submission, data from the device of the
+    # completion
+    if (kind == ord("S") and ep & 0x80 == 0) or (kind == ord("C") and ep & 0x80):
+        if len(data) > 0:
+            return (t, (bus, address), ep, data)
+    return None
+
+
+def read_pcap(data):
+    endian = "<" if data[:4] == b"\xd4\xc3\xb2\xa1" or data[:4] == b"\x4d\x3c\xb2\xa1" else ">"
+    nano = data[:4] in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d")
+    linktype = struct.unpack(endian + "I", data[20:24])[0]
+    hsize = linktype_header_size(linktype)
+    packets = []
+    ofs = 24
+    while ofs + 16 <= len(data):
+        sec, frac, caplen, _ = struct.unpack(endian + "IIII", data[ofs:ofs + 16])
+        record = data[ofs + 16:ofs + 16 + caplen]
+        ofs += 16 + caplen
+        p = usbmon_packet(sec + frac / (1e9 if nano else 1e6), record, record[hsize:])
+        if p is not None:
+            packets.append(p)
+    return packets
+
+
+def read_pcapng(data):
+    packets = []
+    interfaces = []  # (linktype, time units per second)
+    endian = "<"
+    ofs = 0
+    while ofs + 12 <= len(data):
+        if data[ofs:ofs + 4] == b"\x0a\x0d\x0d\x0a":
+            endian = "<" if data[ofs + 8:ofs + 12] == b"\x4d\x3c\x2b\x1a" else ">"
+            interfaces = []
+        kind, length = struct.unpack(endian + "II", data[ofs:ofs + 8])
+        body = data[ofs + 8:ofs + length - 4]
+        ofs += length
+        if length < 12:
+            break
+
+        if kind == 1:  # Interface Description Block
+            linktype = struct.unpack(endian + "H", body[:2])[0]
+            resolution = 10**6
+            opt = 8
+            while opt + 4 <= len(body):
+                code, olen = struct.unpack(endian + "HH", body[opt:opt + 4])
+                if code == 0:
+                    break
+                if code == 9 and olen >= 1:  # if_tsresol
+                    r = body[opt + 4]
+                    resolution = 2**(r & 0x7f) if r & 0x80 else 10**r
+                opt += 4 + (olen + 3) // 4 * 4
+            interfaces.append((linktype, resolution))
+        elif kind == 6:  # Enhanced Packet Block
+            iface, high, low, caplen, _ = struct.unpack(endian + "IIIII", body[:20])
+            linktype, resolution = interfaces[iface]
+            record = body[20:20 + caplen]
+            hsize = linktype_header_size(linktype)
+            p = usbmon_packet(((high << 32) + low) / resolution, record, record[hsize:])
+            if p is not None:
+                packets.append(p)
+    return packets
+
+
+def linktype_header_size(linktype):
+    if linktype == LINKTYPE_USB_LINUX:
+        return 48
+    if linktype == LINKTYPE_USB_LINUX_MMAPPED:
+        return 64
+    sys.stderr.write(f"Unsupported link type {linktype}, the capture must be made with usbmon\n")
+    sys.exit(1)
+
+
+# Example: "ffff88003b4ba0c0 3575914555 C Ii:1:004:2 0:8 64 = 10000d3c 0d010000"
+def read_usbmon_text(lines):
+    packets = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 5 or fields[2] not in ("S", "C") or "=" not in fields:
+            continue
+        address = fields[3].split(":")
+        if len(address) != 4 or address[0][0] in "CZ":  # skip control and isochronous
+            continue
+        ep = int(address[3]) | (0x80 if address[0][1] == "i" else 0)
+        if (fields[2] == "S") != (ep & 0x80 == 0):
+            continue
+        data = bytes.fromhex("".join(fields[fields.index("=") + 1:]))
+        if len(data) > 0:
+            packets.append((int(fields[1]) / 1e6, (int(address[1]), int(address[2])), ep, data))
+    return packets
+
+
+# Reads the HOST> and <PAD blocks of hori_gip_reverse_eng.md. The data of the packets starts
+# at offset 0x40 of the hex dumps (after the usbmon header). There are no timestamps.
+# Sequence numbers written as XX are replaced by a number that pairs each request with the
+# <PAD block after it.
+def read_hexdump_text(lines):
+    packets = []
+    current = None
+    counter = 0
+    for line in lines:
+        line = line.rstrip()
+        if line.startswith("HOST>") or line.startswith("<PAD"):
+            if line.startswith("HOST>"):
+                counter = counter % 255 + 1
+            current = bytearray()
+            packets.append((0.0, (0, 0), 0x02 if line.startswith("HOST>") else 0x82, current))
+            continue
+        fields = line[:54].split()
+        if current is None or len(fields) < 2 or len(fields[0]) != 4:
+            if line.startswith("```"):
+                current = None
+            continue
+        try:
+            ofs = int(fields[0], 16) - 0x40
+            data = bytes(counter if x == "XX" else int(x, 16) for x in fields[1:])
+        except ValueError:
+            continue
+        if ofs >= 0:
+            current[ofs:ofs + len(data)] = data
+    return [(t, dev, ep, bytes(data)) for t, dev, ep, data in packets if len(data) > 0]
+
+
+def read_capture(path):
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError as err:
+        sys.stderr.write(f"{err}\n")
+        sys.exit(1)
+
+    if data[:4] in (b"\xd4\xc3\xb2\xa1", b"\xa1\xb2\xc3\xd4", b"\x4d\x3c\xb2\xa1",
+                    b"\xa1\xb2\x3c\x4d"):
+        return read_pcap(data)
+    if data[:4] == b"\x0a\x0d\x0d\x0a":
+        return read_pcapng(data)
+    lines = data.decode(errors="replace").splitlines()
+    if any(line.startswith("HOST>") for line in lines):
+        return read_hexdump_text(lines)
+    return read_usbmon_text(lines)
+
+
+# Returns the list of (time, request, reply or None) for the GIP requests of <device> (None for
+# the device with the most requests) in <packets>.
+def exchanges(packets, device=None):
+    requests = {}
+    for _, dev, ep, data in packets:
+        if ep == 0x02 and data[0] == hori.GIP_REQUEST and len(data) >= 5:
+            requests[dev] = requests.get(dev, 0) + 1
+    if len(requests) == 0:
+        return []
+    if device is None:
+        device = max(requests, key=requests.get)
+
+    result = []
+    waiting = {}  # sequence number -> index into result
+    for t, dev, ep, data in packets:
+        if dev != device:
+            continue
+        if ep == 0x02 and data[0] == hori.GIP_REQUEST and len(data) >= 5:
+            waiting[data[2]] = len(result)
+            result.append((t, data, None))
+        elif ep == 0x82 and data[0] == hori.GIP_REPLY and len(data) >= 5:
+            if data[4] == hori.REPORT_PROFILE:
+                continue
+            i = waiting.pop(data[2], None)
+            if i is not None:
+                t0, request, _ = result[i]
+                result[i] = (t0, request, (t, data))
+    return result
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# Sends the <recorded> requests to <dev>. With <speed> > 0, the requests are sent at the
+# times of the capture (divided by <speed>), without waiting for the replies to the previous
+# requests. Otherwise each request is sent when the previous one has been answered.
+def replay(dev, recorded, speed, repeat, write, verbose):
+    reader = hori.get_reader(dev)
+    latencies = {}  # cmd -> list of latencies
+    original = {}  # cmd -> list of latencies in the capture
+    pending = {}  # seq -> (time sent, deadline, request, recorded reply)
+    stats = {"skipped": 0, "missing": 0, "divergences": 0}
+
+    def finish(seq, got):
+        sent, _, request, reply = pending.pop(seq)
+        cmd = request[4]
+        if got is not None:
+            latencies.setdefault(cmd, []).append(time.monotonic() - sent)
+        expected = None if reply is None else reply[1]
+        if got is None and expected is not None:
+            stats["missing"] += 1
+
+        if expected is None or got is None:
+            diverged = (expected is None) != (got is None)
+        else:
+            # Only compare the captured bytes, usbmon text captures are truncated
+            n = min(len(expected), len(got))
+            diverged = got[3:n] != expected[3:n]
+        if diverged:
+            stats["divergences"] += 1
+            if verbose or stats["divergences"] <= 10:
+                print(f"Divergence for request {hori.hexstr(request[:4 + min(request[3], 8)])}")
+                print(f"  recorded: {'no reply' if expected is None else hori.hexstr(expected)}")
+                print(f"  received: {'no reply' if got is None else hori.hexstr(got)}")
+
+    # Handles the replies that arrive until time.monotonic() reaches <until> (until all
+    # requests are answered or timed out if None)
+    def collect(until):
+        while len(pending) > 0:
+            oldest = min(pending, key=lambda seq: pending[seq][1])
+            deadline = pending[oldest][1] if until is None else min(until, pending[oldest][1])
+            result = reader.wait(list(pending), deadline)
+            if result is not None:
+                finish(result[0], result[1])
+            elif until is not None and time.monotonic() >= until:
+                return
+            elif time.monotonic() >= pending[oldest][1]:
+                reader.forget(oldest)
+                finish(oldest, None)
+        if until is not None:
+            delay = until - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    start = time.monotonic()
+    t0 = recorded[0][0]
+    duration = recorded[-1][0] - t0
+    for r in range(repeat):
+        for t, request, reply in recorded:
+            cmd = request[4]
+            if cmd in WRITE_COMMANDS and not write:
+                stats["skipped"] += 1
+                continue
+            collect(start + (r * duration + t - t0) / speed if speed > 0 else None)
+
+            # Without a recorded reply, wait as long as hori.py would
+            timeout = hori.reply_timeout if reply is None else max(hori.reply_timeout, 1.0)
+            sent = time.monotonic()
+            seq = hori.send(dev, request[4:4 + request[3]])
+            pending[seq] = (sent, sent + timeout, request, reply)
+            if reply is not None and r == 0:
+                original.setdefault(cmd, []).append(reply[0] - t)
+    collect(None)
+
+    total = time.monotonic() - start
+    print(f"{sum(len(v) for v in latencies.values())} replies in {total:.2f} s "
+          f"(capture: {duration * repeat:.2f} s), {stats['skipped']} requests skipped, "
+          f"{stats['missing']} replies missing, {stats['divergences']} divergences")
+    print(f"{'command':15} {'count':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} "
+          f"{'capture p50':>11}")
+    for cmd, values in sorted(latencies.items()):
+        ms = [v * 1000 for v in values]
+        line = (f"{hori.CMD_NAMES.get(cmd, hex(cmd)):15} {len(ms):6} {percentile(ms, 50):8.2f} "
+                f"{percentile(ms, 90):8.2f} {percentile(ms, 99):8.2f} {max(ms):8.2f}")
+        if cmd in original:
+            line += f" {percentile(original[cmd], 50) * 1000:11.2f}"
+        print(line)
+
+
+def usage():
+    sys.stderr.write(__doc__)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    sim = False
+    device = None
+    speed = 1.0
+    repeat = 1
+    write = False
+    verbose = False
+    args = sys.argv[1:]
+    try:
+        while len(args) > 1:
+            arg = args.pop(0)
+            if arg == "--sim":
+                sim = True
+            elif arg == "-d":
+                hori.devnum = int(args.pop(0), 10)
+            elif arg == "--device":
+                bus, _, address = args.pop(0).partition(":")
+                device = (int(bus, 10), int(address, 10))
+            elif arg == "--speed":
+                speed = float(args.pop(0))
+            elif arg == "--repeat":
+                repeat = int(args.pop(0), 10)
+            elif arg == "--write":
+                write = True
+            elif arg == "-v":
+                verbose = True
+            else:
+                usage()
+    except (IndexError, ValueError):
+        usage()
+    if len(args) != 1 or speed < 0 or repeat < 1:
+        usage()
+
+    recorded = exchanges(read_capture(args[0]), device)
+    if len(recorded) == 0:
+        sys.stderr.write("No GIP requests found in the capture\n")
+        sys.exit(1)
+
+    try:
+        if sim:
+            import hori_sim
+            dev = hori_sim.SimulatedController()
+        else:
+            hori.check_device()
+            dev = hori.get_controller()
+        try:
+            replay(dev, recorded, speed, repeat, write, verbose)
+        finally:
+            hori.release_controller(dev)
+    except hori.HoriError as err:
+        sys.stderr.write(f"{err}\n")
+        sys.exit(1)